@@ -10,13 +10,28 @@ import shutil
 import sys
 import logging
 import errno
+import stat
 import logging.handlers
 import ConfigParser
 import re
 import datetime, time
 import glob
+import threading
+import Queue
+import subprocess
+import json
 from git import *
 
+# the scandir package saves a stat call per entry, fall back to listdir and lstat without it
+try:
+	from scandir import scandir
+except ImportError:
+	scandir = None
+
+# the trashcan module is shared with buildqueue
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'trashcan'))
+import trashcan
+
 # prints stacktraces for each thread
 # acquired from http://code.activestate.com/recipes/577334-how-to-debug-deadlocked-multi-threaded-programs/
 #sys.path.append('/path/to/tracemodule')
@@ -46,8 +61,26 @@ class Config(ConfigParser.SafeConfigParser):
 			defaultConfig.write('[general]\n')
 			defaultConfig.write('# loglevel may be one of: debug, info, warning, error, critical\n')
 			defaultConfig.write('loglevel   : \n')
+			defaultConfig.write('# number of threads removing directories in parallel (default 4)\n')
+			defaultConfig.write('concurrency : 4\n')
+			defaultConfig.write('# io scheduling class used while removing: idle, best-effort or none (default idle)\n')
+			defaultConfig.write('ioclass : idle\n')
+			defaultConfig.write('# move directories to a trash first and remove them from there in the background (default no)\n')
+			defaultConfig.write('trash : no\n')
+			defaultConfig.write('# files per second removed from the trash, 0 for no limit (default 0)\n')
+			defaultConfig.write('trashrate : 0\n')
+			defaultConfig.write('# when a filesystem is fuller than highwatermark percent, remove the largest and oldest\n')
+			defaultConfig.write('# build directories until it is at lowwatermark percent; 0 disables this (default 0)\n')
+			defaultConfig.write('highwatermark : 0\n')
+			defaultConfig.write('lowwatermark : 0\n')
 			defaultConfig.write('[git]\n')
 			defaultConfig.write('repository : <repository url>\n')
+			defaultConfig.write('# bare mirror without file contents, shared by all platforms (default ~/.buildbot-cleanup.d/mirror.git)\n')
+			defaultConfig.write('mirror : \n')
+			defaultConfig.write('# seconds the list of branches on the remote is reused (default 300)\n')
+			defaultConfig.write('cachettl : 300\n')
+			defaultConfig.write('# remove the build directories of branches without commits for this many days, 0 to keep them (default 0)\n')
+			defaultConfig.write('inactivedays : 0\n')
 			defaultConfig.write('[buildpaths]\n')
 			defaultConfig.write('<platform> : <directory containing build directories>')
 			defaultConfig.close()
@@ -63,6 +96,12 @@ class Config(ConfigParser.SafeConfigParser):
 	def getItems(self, category):
 		return self.items(category)
 
+	def getIntValue(self, category, attribute, default):
+		try:
+			return self.getint(category, attribute)
+		except (ConfigParser.Error, ValueError):
+			return default
+
 class RepositoryError(Exception):
 	def __init__(self, value):
 		self.value = value
@@ -71,32 +110,118 @@ class RepositoryError(Exception):
 		return repr(self.value)
 
 class GitClient():
-	def __init__(self, repository, path):
+	''' Access to the remote through a single bare mirror without file contents
+
+	The heads of the remote are listed with one ls-remote, and the result is cached next
+	to the mirror for cachettl seconds so repeated runs don't ask the remote again. '''
+	def __init__(self, repository, path, cachettl=300):
+		self.repository = repository
+		self.cachefile = os.path.join(os.path.dirname(os.path.abspath(path)), 'heads.json')
+		self.cachettl = cachettl
+		self.heads = None
 		if not os.path.exists(path):
-			self.repo = Repo.clone_from(repository, path)
+			try:
+				# only commits and trees are needed, leave the blobs on the server
+				self.repo = Repo.clone_from(repository, path, bare=True, filter='blob:none')
+			except GitCommandError, e:
+				raise RepositoryError(str(e))
 		else:
 			try:
 				self.repo = Repo(path)
-			except GitCommandError, e:
+			except (GitCommandError, InvalidGitRepositoryError, NoSuchPathError), e:
 				raise RepositoryError(str(e))
 
+	def getHeads(self):
+		# returns a dictionary of branch name -> sha of the head on the remote
+		if self.heads is not None:
+			return self.heads
+
+		try:
+			f = open(self.cachefile, 'r')
+			cache = json.load(f)
+			f.close()
+			if cache['repository'] == self.repository and time.time() - cache['time'] < self.cachettl:
+				self.heads = dict([(str(name), str(sha)) for name, sha in cache['heads'].items()])
+				return self.heads
+		except (IOError, ValueError, KeyError):
+			pass
+
+		heads = {}
+		try:
+			output = Git().ls_remote('--heads', self.repository)
+		except GitCommandError, e:
+			raise RepositoryError(str(e))
+		for line in output.split('\n'):
+			if '\trefs/heads/' not in line:
+				continue
+			sha, ref = line.split('\t', 1)
+			heads[ref[len('refs/heads/'):]] = sha
+
+		try:
+			f = open(self.cachefile + '.tmp', 'w')
+			json.dump({'repository': self.repository, 'time': time.time(), 'heads': heads}, f)
+			f.close()
+			os.rename(self.cachefile + '.tmp', self.cachefile)
+		except (IOError, OSError), e:
+			logger.warning('could not write the branch cache: ' + str(e))
+
+		self.heads = heads
+		return self.heads
+
 	def getBranchList(self):
-		branchList = []
-		g = Git(self.repo.git_dir)
-		for head in g.ls_remote("--heads", "origin").split('\n'):
-			headname = head.split('/')[2]
-			#if head.name != 'origin/HEAD':
-			#	branchList.append(head.name)
-			branchList.append(headname)
-
-		return branchList
-
-	def removeInactiveBranches(self, branchlist):
-		branchList = branchlist
-		g = Git(self.repo.git_dir)
+		return sorted(self.getHeads().keys())
+
+	def getLastCommitTimes(self):
+		# returns a dictionary of branch name -> time of the last commit, None if unknown.
+		# The times are cached by head sha, only heads that moved are fetched and looked up.
+		heads = self.getHeads()
+		activityfile = os.path.join(os.path.dirname(self.cachefile), 'activity.json')
+		try:
+			f = open(activityfile, 'r')
+			times = json.load(f)
+			f.close()
+		except (IOError, ValueError):
+			times = {}
+
+		missing = [name for name, sha in heads.items() if sha not in times]
+		if missing:
+			try:
+				# fetch in chunks to stay below the command line length limits
+				for i in range(0, len(missing), 500):
+					self.repo.git.fetch('origin', *['+refs/heads/' + name + ':refs/heads/' + name for name in missing[i:i + 500]])
+				# a single for-each-ref gives the commit time of every head
+				for line in self.repo.git.for_each_ref('--format=%(objectname) %(committerdate:raw)', 'refs/heads').split('\n'):
+					fields = line.split()
+					if len(fields) >= 2:
+						times[fields[0]] = int(fields[1])
+			except GitCommandError, e:
+				logger.warning('could not determine the branch activity: ' + str(e))
+
+		# only remember the current heads
+		shas = set(heads.values())
+		times = dict([(sha, timestamp) for sha, timestamp in times.items() if sha in shas])
+		try:
+			f = open(activityfile + '.tmp', 'w')
+			json.dump(times, f)
+			f.close()
+			os.rename(activityfile + '.tmp', activityfile)
+		except (IOError, OSError), e:
+			logger.warning('could not write the branch activity cache: ' + str(e))
+
+		return dict([(name, times.get(sha)) for name, sha in heads.items()])
+
+	def removeInactiveBranches(self, branchList, days=30):
+		# returns the branches of branchList that got a commit in the last days; branches of
+		# which the activity is unknown are kept
+		times = self.getLastCommitTimes()
+		limit = time.time() - days * 24 * 3600
+		activeList = []
 		for branch in branchList:
-			commit = g.log("--since={`date --date=\"$(date +%Y-%m-15) -1 month\" \"+%Y-%m-01\"`}", "-n1", "--", "origin", branch)
-			print commit
+			if times.get(branch) is None or times[branch] >= limit:
+				activeList.append(branch)
+			else:
+				logger.info('inactive branch: ' + branch)
+		return activeList
 
 	def switch(self, release, path):
 		if release == 'development':
@@ -110,8 +235,9 @@ class GitClient():
 		return True
 
 	def update(self):
+		# bring the heads of the mirror up to date with the remote
 		try:
-			self.repo.remotes.origin.pull()
+			self.repo.git.fetch('--prune', 'origin', '+refs/heads/*:refs/heads/*')
 		except GitCommandError, e:
 			raise RepositoryError(str(e))
 
@@ -131,6 +257,247 @@ class GitClient():
 			except GitCommandError, e:
 				raise RepositoryError("Can not commit local changes in configrepo during startup" + str(e))
 
+class Deleter():
+	''' Removes directory trees with a pool of worker threads
+
+	The entries directly below a doomed directory are removed as separate jobs, so a single
+	large build directory is spread over the workers as well. The directories themselves are
+	removed once their contents are gone, in finish().
+
+	With a trashcan, directories are moved into the trash instead, which frees their names
+	immediately; the reaper of the trashcan removes them. '''
+	def __init__(self, concurrency, trashCan=None):
+		self.trashCan = trashCan
+		self.jobs = Queue.Queue()
+		self.lock = threading.Lock()
+		self.parents = []
+		self.files = 0
+		self.bytes = 0
+		self.started = time.time()
+		self.workers = []
+		for i in range(max(1, concurrency)):
+			worker = threading.Thread(target=self.work, name='deleter-' + str(i))
+			worker.setDaemon(True)
+			worker.start()
+			self.workers.append(worker)
+
+	def remove(self, path, description, trash=None):
+		# queue path for removal, description is used in the log messages. trash is passed
+		# on to the trashcan, by default the trash is next to path.
+		logger.info(description + path)
+		if self.trashCan and self.trashCan.trash(path, trash):
+			return
+
+		if not os.path.isdir(path) or os.path.islink(path):
+			self.jobs.put(path)
+			return
+
+		try:
+			entries = os.listdir(path)
+		except OSError, e:
+			logger.warning('failed to remove ' + path + ' :' + str(e))
+			return
+
+		self.parents.append(path)
+		for entry in entries:
+			self.jobs.put(os.path.join(path, entry))
+
+	def work(self):
+		while True:
+			path = self.jobs.get()
+			if path is None:
+				return
+			self.removeTree(path)
+
+	def removeTree(self, path):
+		files = 0
+		size = 0
+		try:
+			if os.path.isdir(path) and not os.path.islink(path):
+				for root, dirs, filenames in os.walk(path, topdown=False):
+					for filename in filenames + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+						size += self.unlink(os.path.join(root, filename))
+						files += 1
+					os.rmdir(root)
+			else:
+				size += self.unlink(path)
+				files += 1
+		except OSError, e:
+			logger.warning('failed to remove ' + path + ' :' + str(e))
+
+		self.lock.acquire()
+		self.files += files
+		self.bytes += size
+		self.lock.release()
+
+	def unlink(self, path):
+		size = os.lstat(path).st_size
+		os.remove(path)
+		return size
+
+	def finish(self):
+		# wait for the workers, remove the emptied directories and report the throughput
+		for worker in self.workers:
+			self.jobs.put(None)
+		for worker in self.workers:
+			worker.join()
+
+		for path in self.parents:
+			try:
+				os.rmdir(path)
+			except OSError, e:
+				logger.warning('failed to remove ' + path + ' :' + str(e))
+
+		if self.trashCan:
+			self.trashCan.wait()
+			self.files += self.trashCan.files
+			self.bytes += self.trashCan.bytes
+
+		elapsed = max(time.time() - self.started, 0.001)
+		logger.info('removed %d files, %.1f MB in %.1f seconds (%.0f files/s, %.1f MB/s)' % (self.files, self.bytes / 1048576.0, elapsed, self.files / elapsed, self.bytes / 1048576.0 / elapsed))
+
+class DiskUsageIndex():
+	''' Persistent index of the size and last modification of the build directories below path
+
+	Every directory is stored with its mtime, the size and newest mtime of the files directly
+	in it and its subdirectories. A directory whose mtime did not change since the last scan
+	is taken from the index without listing it again. Files that only grew in place don't
+	change the mtime of their directory, so the sizes are an estimate, which is all the
+	eviction needs. The build directories are scanned in parallel. '''
+	def __init__(self, indexfile, path, concurrency):
+		self.indexfile = indexfile
+		self.path = path
+		self.concurrency = max(1, concurrency)
+		self.lock = threading.Lock()
+		try:
+			f = open(self.indexfile, 'r')
+			self.dirs = json.load(f)
+			f.close()
+		except (IOError, ValueError):
+			self.dirs = {}
+		self.visited = {}
+
+	def save(self):
+		try:
+			f = open(self.indexfile + '.tmp', 'w')
+			json.dump(self.visited, f)
+			f.close()
+			os.rename(self.indexfile + '.tmp', self.indexfile)
+		except (IOError, OSError), e:
+			logger.warning('could not write the disk usage index: ' + str(e))
+
+	def scan(self, builddirs):
+		# returns a dictionary of builddir -> (bytes, newest mtime)
+		jobs = Queue.Queue()
+		for builddir in builddirs:
+			jobs.put(builddir)
+		usage = {}
+
+		def work():
+			while True:
+				try:
+					builddir = jobs.get_nowait()
+				except Queue.Empty:
+					return
+				result = self.scanTree(os.path.join(self.path, builddir))
+				self.lock.acquire()
+				usage[builddir] = result
+				self.lock.release()
+
+		workers = [threading.Thread(target=work) for i in range(min(self.concurrency, len(builddirs)))]
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+
+		self.save()
+		return usage
+
+	def scanTree(self, top):
+		total = 0
+		newest = 0
+		pending = [top]
+		while pending:
+			directory = pending.pop()
+			try:
+				mtime = os.lstat(directory).st_mtime
+			except OSError:
+				continue
+
+			entry = self.dirs.get(directory)
+			if entry is None or entry[0] != mtime:
+				entry = [mtime] + self.listDirectory(directory)
+
+			self.lock.acquire()
+			self.visited[directory] = entry
+			self.lock.release()
+
+			total += entry[1]
+			newest = max(newest, mtime, entry[2])
+			pending.extend([os.path.join(directory, subdir) for subdir in entry[3]])
+
+		return total, newest
+
+	def listDirectory(self, directory):
+		# returns [bytes in files, newest file mtime, subdirectories]
+		size = 0
+		newest = 0
+		subdirs = []
+		try:
+			if scandir:
+				for entry in scandir(directory):
+					if entry.is_dir(follow_symlinks=False):
+						subdirs.append(entry.name)
+					else:
+						info = entry.stat(follow_symlinks=False)
+						size += info.st_size
+						newest = max(newest, info.st_mtime)
+			else:
+				for name in os.listdir(directory):
+					info = os.lstat(os.path.join(directory, name))
+					if stat.S_ISDIR(info.st_mode):
+						subdirs.append(name)
+					else:
+						size += info.st_size
+						newest = max(newest, info.st_mtime)
+		except OSError, e:
+			logger.debug('could not scan ' + directory + ': ' + str(e))
+		return [size, newest, subdirs]
+
+def filesystemUsage(path):
+	# returns (device, total bytes, used bytes) of the filesystem containing path, None if unknown
+	if not hasattr(os, 'statvfs'):
+		return None
+	info = os.statvfs(path)
+	total = info.f_blocks * info.f_frsize
+	return os.stat(path).st_dev, total, total - info.f_bavail * info.f_frsize
+
+def selectEvictions(usage, total, used, high, low):
+	# returns the build directories to remove to get from above high to low percent usage,
+	# the largest and oldest first
+	if used * 100 <= high * total:
+		return []
+
+	now = time.time()
+	candidates = sorted(usage.items(), key=lambda item: item[1][0] * max(now - item[1][1], 1), reverse=True)
+	evictions = []
+	for builddir, (size, newest) in candidates:
+		if used * 100 <= low * total:
+			break
+		evictions.append(builddir)
+		used -= size
+	return evictions
+
+def setIOClass(ioclass):
+	# lower the io priority of the process, threads started afterwards inherit it
+	classes = {'idle': '3', 'best-effort': '2'}
+	if ioclass not in classes or not sys.platform.startswith('linux'):
+		return
+	try:
+		subprocess.call(['ionice', '-c', classes[ioclass], '-p', str(os.getpid())])
+	except OSError, e:
+		logger.warning('could not set the io class: ' + str(e))
+
 ##################################################################################
 def main():
 	#stacktracer.trace_start("trace.html",interval=5,auto=True)
@@ -157,22 +524,47 @@ def main():
 
 	logger.info('#############################################')
 
-        # The following builds up a list of branches that may be removed from the buildslave output directories
-	for platform, path in config.getItems('buildpaths'):
-		logger.debug('platform: ' + platform)
-		global repo
-		try:
-			repo = GitClient(config.get('git', 'repository'), path)
-		except RepositoryError, e:
-			logger.error('could not connect to git remote: ' + e)
-			sys.exit()
-
+	try:
+		ioclass = config.getValue('general', 'ioclass')
+	except ConfigParser.Error:
+		ioclass = 'idle'
+	setIOClass(ioclass)
+	trashCan = None
+	try:
+		if config.getboolean('general', 'trash'):
+			trashCan = trashcan.TrashCan(config.getIntValue('general', 'trashrate', 0), logger)
+			trashCan.start()
+			# finish the trash an earlier run left behind
+			for platform, path in config.getItems('buildpaths'):
+				try:
+					trashCan.adopt(trashcan.findTrash(path))
+				except OSError:
+					pass
+	except (ConfigParser.Error, ValueError):
+		pass
+	deleter = Deleter(config.getIntValue('general', 'concurrency', 4), trashCan)
+
+	# The following builds up a list of branches that may be removed from the buildslave output directories
+	# The branches are the same for every platform, so a single mirror and ls-remote serve all of them
+	try:
+		mirror = config.getValue('git', 'mirror')
+	except ConfigParser.Error:
+		mirror = ''
+	if not mirror:
+		mirror = '~/.buildbot-cleanup.d/mirror.git'
+
+	global repo
+	try:
+		repo = GitClient(config.get('git', 'repository'), os.path.expanduser(mirror), config.getIntValue('git', 'cachettl', 300))
 		# 1. Get a list of branches found on the server
 		branchList = repo.getBranchList()
+	except RepositoryError, e:
+		logger.error('could not connect to git remote: ' + str(e))
+		sys.exit()
 
-		logger.debug('#############################################')
-		for branch in branchList:
-			logger.debug('found branch: ' + branch)
+	logger.debug('#############################################')
+	for branch in branchList:
+		logger.debug('found branch: ' + branch)
 
 	# 2. Remove the integrated branches from the branchList to get a list of branches which will get commits and will be build
 	# The branchList now contains branches that have a builddirectory (actively committed to), and branches that don't (old
@@ -181,14 +573,21 @@ def main():
 	# 3. Remove the inactive (last commit > 30 days ago) from the branchList to get a list of branches that are actively used
 	# and will be build.
 	# The branchList now contains branches that have a builddirectory (actively committed to)
-	#repo.removeInactiveBranches(branchList)
+	inactiveDays = config.getIntValue('git', 'inactivedays', 0)
+	if inactiveDays > 0:
+		branchList = repo.removeInactiveBranches(branchList, inactiveDays)
+
+	highWatermark = config.getIntValue('general', 'highwatermark', 0)
+	lowWatermark = config.getIntValue('general', 'lowwatermark', 0)
+	# bytes that are being removed per filesystem, statvfs won't show that yet
+	pendingFree = {}
 
 	# 4. Retreive a list of builddirectories per platform
 	for platform, path in config.getItems('buildpaths'):
 		absolutePath = os.path.normpath(os.path.expandvars(str(path) + '/../'))
 		logger.info('#############################################')
 		logger.info('Found path: ' + platform + ' ' + absolutePath)
-		builddirList = os.listdir(absolutePath)
+		builddirList = [builddir for builddir in os.listdir(absolutePath) if builddir != trashcan.TRASH]
 
 		# 5. Remove branches from the builddirlist that have a corresponding branch on the repository
 		# If a branch does not have a builddirectory it is probably not active / old; report those.
@@ -207,14 +606,10 @@ def main():
                 # 6. Remove build results that have been sent to the dashboard
 		logger.info('#############################################')
 		logger.info('Buildresults that have been sent to the dashboard: ')
+		# they are only removed after step 9, which may remove their whole build directory
+		intermediates = {}
 		for builddirname in buildDirsToKeep:
-                    intermediates = glob.glob(absolutePath + '/' + builddirname + '/Testing/[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]')
-                    for intermediate in intermediates:
-                            try:
-                                    logger.info(platform + ': removing build results directory: ' + intermediate)
-                                    shutil.rmtree(intermediate)
-                            except OSError, e:
-                                    logger.warning(platform + ': failed to remove build results directory: ' + intermediate + ' :' + str(e))
+			intermediates[builddirname] = glob.glob(absolutePath + '/' + builddirname + '/Testing/[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]')
 
 		logger.info('#############################################')
 
@@ -225,17 +620,46 @@ def main():
 		except:
 			logger.debug(platform + ': no checkoutdirectory exists')
 
+		# Measure the build directories before removing anything, so the space that steps 8 and 9
+		# free can be accounted for before the trash is actually emptied.
+		usage = {}
+		filesystem = None
+		if highWatermark > 0:
+			builddirs = [builddir for builddir in os.listdir(absolutePath) if builddir not in ('build', trashcan.TRASH) and os.path.isdir(absolutePath + '/' + builddir)]
+			index = DiskUsageIndex(os.path.join(os.path.dirname(repo.cachefile), 'usage-' + platform + '.json'), absolutePath, config.getIntValue('general', 'concurrency', 4))
+			usage = index.scan(builddirs)
+			filesystem = filesystemUsage(absolutePath)
+			if filesystem is None:
+				logger.warning(platform + ': can not determine the disk usage on this platform')
+
 		# 8. Remove the build directories for which no branch exists on the repository,
 		# or if the branch has already been integrated (see step 2).
 		# or if there hasn't been a commit in 30 days (see step 3).
 		logger.info('Builddirectories without branch: ')
 		for builddir in builddirList[:]:
-			try:
-				logger.info(platform + ': removing build directory: ' + absolutePath + '/' + builddir)
-				shutil.rmtree(absolutePath + '/' + builddir)
-			except OSError, e:
-				logger.warning(platform + ': failed to remove build directory: ' + absolutePath + '/' + builddir + ' :' + str(e))
-
+			deleter.remove(absolutePath + '/' + builddir, platform + ': removing build directory: ')
+			if filesystem:
+				pendingFree[filesystem[0]] = pendingFree.get(filesystem[0], 0) + usage.pop(builddir, (0, 0))[0]
+
+		# 9. If the disk is still too full, remove the largest and oldest of the remaining build directories.
+		# They will get rebuilt from scratch the next time their branch is built.
+		if filesystem:
+			device, total, used = filesystem
+			used -= pendingFree.get(device, 0)
+			logger.info(platform + ': disk usage %.0f%%, build directories use %.1f GB' % (used * 100.0 / total, sum([size for size, newest in usage.values()]) / 1073741824.0))
+			for builddir in selectEvictions(usage, total, used, highWatermark, lowWatermark or highWatermark):
+				deleter.remove(absolutePath + '/' + builddir, platform + ': removing build directory to free space: ')
+				pendingFree[device] = pendingFree.get(device, 0) + usage[builddir][0]
+				intermediates.pop(builddir, None)
+
+		# the build results of step 6 in the build directories that are kept
+		for builddirname in sorted(intermediates.keys()):
+			for intermediate in intermediates[builddirname]:
+				# into the trash of the build directories, not one inside the kept build directory
+				deleter.remove(intermediate, platform + ': removing build results directory: ', trashcan.findTrash(absolutePath + '/' + builddirname))
+
+	# the directories of all platforms are removed in parallel, wait for them
+	deleter.finish()
 	logger.info('#############################################')
 	logger.debug('done.')
 	#stacktracer.trace_stop()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# Runs a buildqueue coordinator with a number of build agents on localhost. The coordinator
+# queues synthetic builds that only sleep, the agents are separate processes that lease them
+# over the status port, send heartbeats and report the results, exactly like remote agents.
+# Killing an agent while it builds shows its lease expiring and the build being queued again.
+#
+# usage: agent-demo.py [builds] [agents] [build seconds] [platforms]
+#        agent-demo.py agent <port> <platform> <name>   (started by the demo itself)
+
+import os
+import sys
+import time
+import socket
+import logging
+import subprocess
+import ConfigParser
+import buildqueue
+
+class SyntheticBuild(buildqueue.Build):
+	def prebuild(self):
+		self.newbuild = True
+		return True
+
+	def build(self):
+		time.sleep(float(self.path))
+		return 0
+
+buildqueue.buildClasses['SyntheticBuild'] = SyntheticBuild
+
+def freePort():
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+def agent(port, platform, name):
+	buildqueue.config = ConfigParser.SafeConfigParser()
+	thread = buildqueue.AgentThreadClass(('127.0.0.1', int(port)), platform, name, 0.2, 1)
+	thread.setDaemon(True)
+	thread.start()
+	while True:
+		time.sleep(1)
+
+def main():
+	builds    = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+	agents    = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+	buildtime = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+	platforms = (sys.argv[4] if len(sys.argv) > 4 else 'linux-x86,windows-x86').split(',')
+
+	buildqueue.BuildQueues = [buildqueue.BuildQueue(0, platform) for platform in platforms]
+	buildqueue.leases = buildqueue.LeaseTable(3)
+	port = freePort()
+	server = buildqueue.SocketThreadClass(port)
+	server.setDaemon(True)
+	server.start()
+
+	for i in range(builds):
+		build = SyntheticBuild('branch%d' % i, str(buildtime), 'experimental')
+		buildqueue.addToBuildQueues(build)
+	total = builds * len(platforms)
+
+	started = time.time()
+	processes = []
+	for i in range(agents):
+		platform = platforms[i % len(platforms)]
+		processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), 'agent', str(port), platform, 'agent%d' % i]))
+
+	# kill one agent in the middle of a build, its build must be done by another one
+	time.sleep(buildtime / 2 + 1)
+	if len(processes) > len(platforms):
+		print 'killing agent0'
+		processes[0].kill()
+
+	while any([not bqueue.empty() or bqueue.running for bqueue in buildqueue.BuildQueues]):
+		time.sleep(0.1)
+	elapsed = time.time() - started
+
+	for process in processes:
+		if process.poll() is None:
+			process.kill()
+		process.wait()
+
+	print '%d builds of %.1fs on %d platforms by %d agents in %.1fs' % (total, buildtime, len(platforms), agents, elapsed)
+	print ''.join([line + '\n' for line in buildqueue.metrics.asText().split('\n') if line.startswith('buildqueue_builds_total')])
+
+##################################################################################
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+	buildqueue.log = logging.getLogger()
+	if len(sys.argv) > 1 and sys.argv[1] == 'agent':
+		agent(*sys.argv[2:5])
+	else:
+		main()
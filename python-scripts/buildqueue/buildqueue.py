@@ -4,6 +4,10 @@
 # I currently have 3 types of builds: linux arm, linux x86 and windows x86. This tool
 # needs to check the branches periodically to see if I have committed anywhere, and 
 # automatically start a build.
+#
+# Started with --agent <host>:<port> it doesn't poll the repositories but builds for the
+# buildqueue running on host: it leases builds for its platforms over the status port,
+# sends heartbeats while building and reports the results back.
 
 import os
 import shutil
@@ -19,10 +23,23 @@ import errno
 import subprocess
 import ConfigParser
 import logging.handlers
-import pickle # for timestamp
+import pickle
+import sqlite3
 import copy
+import itertools
+import heapq
+import collections
+import signal
+import hashlib
 import socket
-import HTMLgen
+import select
+import cgi
+import json
+import uuid
+
+# the trashcan module is shared with buildbot-cleanup
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'trashcan'))
+import trashcan
 
 # prints stacktraces for each thread
 # acquired from http://code.activestate.com/recipes/577334-how-to-debug-deadlocked-multi-threaded-programs/
@@ -30,74 +47,426 @@ import HTMLgen
 #import stacktracer
 
 ## TODO
-# -- add git repo support
 # -- replace while true with decent condition
 # -- remove log output from terminal
 
 ##################################################################################
+class Metrics():
+	''' Thread safe counters and histograms, rendered in the prometheus text format '''
+	buckets = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.help = {}
+		self.counters = {} # (name, labels) -> value
+		self.histograms = {} # (name, labels) -> [bucket counts, sum, count]
+
+	def describe(self, name, kind, text):
+		self.help[name] = (kind, text)
+
+	def increment(self, name, labels=(), value=1):
+		self.lock.acquire()
+		self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+		self.lock.release()
+
+	def observe(self, name, labels, value):
+		self.lock.acquire()
+		histogram = self.histograms.setdefault((name, labels), [[0] * len(self.buckets), 0.0, 0])
+		for i in range(len(self.buckets)):
+			if value <= self.buckets[i]:
+				histogram[0][i] += 1
+		histogram[1] += value
+		histogram[2] += 1
+		self.lock.release()
+
+	def asText(self, gauges=()):
+		# gauges are (name, labels, value) tuples sampled by the caller
+		self.lock.acquire()
+		counters = self.counters.items()
+		histograms = [(key, (histogram[0][:], histogram[1], histogram[2])) for key, histogram in self.histograms.items()]
+		self.lock.release()
+
+		lines = []
+		described = set()
+		def header(name):
+			if name not in described and name in self.help:
+				described.add(name)
+				lines.append('# HELP ' + name + ' ' + self.help[name][1])
+				lines.append('# TYPE ' + name + ' ' + self.help[name][0])
+
+		for name, labels, value in sorted(gauges):
+			header(name)
+			lines.append(name + formatLabels(labels) + ' ' + str(value))
+
+		for (name, labels), value in sorted(counters):
+			header(name)
+			lines.append(name + formatLabels(labels) + ' ' + str(value))
+
+		for (name, labels), (counts, total, count) in sorted(histograms):
+			header(name)
+			for i in range(len(self.buckets)):
+				lines.append(name + '_bucket' + formatLabels(labels + (('le', str(self.buckets[i])),)) + ' ' + str(counts[i]))
+			lines.append(name + '_bucket' + formatLabels(labels + (('le', '+Inf'),)) + ' ' + str(count))
+			lines.append(name + '_sum' + formatLabels(labels) + ' ' + repr(total))
+			lines.append(name + '_count' + formatLabels(labels) + ' ' + str(count))
+
+		return '\n'.join(lines) + '\n'
+
+def formatLabels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join([key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for key, value in labels]) + '}'
+
+metrics = Metrics()
+
+# order in which revisions were found, a git sha alone does not tell which one is newer
+revisionsFound = itertools.count()
+metrics.describe('buildqueue_queued_builds', 'gauge', 'Builds waiting in the queue of a platform.')
+metrics.describe('buildqueue_running_builds', 'gauge', 'Builds currently running for a platform.')
+metrics.describe('buildqueue_enqueued_total', 'counter', 'Builds handed to the buildqueues.')
+metrics.describe('buildqueue_enqueue_skipped_total', 'counter', 'Branches not enqueued as they had no new commits.')
+metrics.describe('buildqueue_superseded_total', 'counter', 'Queued builds that were switched to a newer revision.')
+metrics.describe('buildqueue_cancelled_total', 'counter', 'Running builds that were cancelled.')
+metrics.describe('buildqueue_queue_wait_seconds', 'histogram', 'Time between enqueueing a build and a worker picking it up.')
+metrics.describe('buildqueue_prebuild_seconds', 'histogram', 'Time spent exporting and checking the buildscript.')
+metrics.describe('buildqueue_build_seconds', 'histogram', 'Wall clock time of the ctest run.')
+metrics.describe('buildqueue_builds_total', 'counter', 'Finished builds by exit code.')
+
 class BuildQueue(Queue.PriorityQueue):
-	''' Wrapper class for Queue to filter out double entries '''
-	def __init__(self, queuelength, platform):
+	''' Wrapper class for Queue to filter out double entries
+
+	Builds are ordered on the time they were enqueued, minus a boost in seconds for nightly
+	and trunk builds. A branch therefore only waits for trunk builds that arrived up to the
+	boost after it, so it can't starve. With shortestFirst the expected duration of a build,
+	learned from earlier builds of the branch, is added as well. Equal keys keep their
+	insertion order through a sequence number.
+
+	A branch build only becomes runnable after quietPeriod seconds without a newer commit, so
+	a burst of commits results in a single build. A newer revision of a queued branch takes
+	over the queued entry in place. Nightly builds are never held back or replaced. With
+	cancelSuperseded a running build of the branch is cancelled as soon as a newer revision
+	gets queued. '''
+	def __init__(self, queuelength, platform, boosts=None, shortestFirst=False, store=None, quietPeriod=0, cancelSuperseded=False):
 		Queue.PriorityQueue.__init__(self, queuelength)
 		self.builds = {} # maintain a hash of branches added to sift out doubles
 		self.lock = threading.Lock()
 		self.platform = platform
-		self.current = ""
-	
-	def enqueue(self, item):
-		# if a build is in the queue then don't add it again
+		self.running = {} # branches currently being built by the worker threads of this queue
+		# signalled whenever a build is added, so idle workers don't have to poll
+		self.available = threading.Condition(self.lock)
+		self.boosts = boosts if boosts is not None else {'nightly': 3600, 'trunk': 1800}
+		self.shortestFirst = shortestFirst
+		self.durations = {} # moving average of the build time per branch
+		self.sequence = itertools.count()
+		self.store = store # optional BuildStore recording the life cycle of every build
+		self.quietPeriod = quietPeriod
+		self.notBefore = {} # time at which the queued build of a branch becomes runnable
+		self.cancelSuperseded = cancelSuperseded
+		self.stopping = False
+
+	def priority(self, build):
+		key = time.time()
+		if build.buildtype == 'nightly':
+			key -= self.boosts.get('nightly', 0)
+		elif build.name == 'trunk':
+			key -= self.boosts.get('trunk', 0)
+
+		if self.shortestFirst:
+			key += self.durations.get(build.name, 0)
+
+		return key
+
+	def recordDuration(self, name, seconds):
+		self.lock.acquire()
+		if name in self.durations:
+			self.durations[name] = 0.7 * self.durations[name] + 0.3 * seconds
+		else:
+			self.durations[name] = seconds
+		self.lock.release()
+
+	def enqueue(self, build):
+		# returned value consists of: priority, sequence number, build object
 		self.lock.acquire()
 		try:
-			if(self.builds[item[2].name]):
+			build.enqueuedTime = time.time()
+			item = (self.priority(build), self.sequence.next(), build)
+			# if a build is in the queue then don't add it again
+			ownId = build.storeId # only restored builds have a row already
+			if(self.builds.get(build.name)):
 				# The queue already contains the branch meant for nightly, insert anyway
-                # The branch on the queue is 'experimental' as the timestamp check prevents multiple nightlies
-				if(item[2].buildtype == 'nightly'):
+				# The branch on the queue is 'experimental' as the timestamp check prevents multiple nightlies
+				if(build.buildtype == 'nightly'):
 					self.put_nowait(item)
+				elif self.supersede(build):
+					log.debug('Branch ' + build.name + ' in the ' + self.platform + ' queue now builds revision ' + str(build.getRevision()))
+					metrics.increment('buildqueue_superseded_total', (('platform', self.platform),))
+					self.debounce(build)
+					if self.store:
+						self.store.superseded(build)
+						if ownId is not None and ownId != build.storeId:
+							self.store.replaced(ownId)
+					self.cancelObsolete(build)
+					return True
 				else:
-					log.debug('Branch ' + item[2].name + ' is already in the ' + self.platform + ' queue - skipping')
-		except KeyError:
-			# else put it in the buildqueue
-			self.put_nowait(item)
-			self.builds[item[2].name] = True
+					log.debug('Branch ' + build.name + ' is already in the ' + self.platform + ' queue - skipping')
+					return False
+			else:
+				# else put it in the buildqueue
+				self.put_nowait(item)
+				self.builds[build.name] = True
+			self.debounce(build)
+			if self.store:
+				self.store.queued(self.platform, build)
+			self.cancelObsolete(build)
+			self.available.notify()
+			return True
+		finally:
+			self.lock.release()
+
+	def cancelObsolete(self, build):
+		# cancel the running build of the branch if build is a newer revision of it.
+		# Must be called with self.lock held.
+		running = self.running.get(build.name)
+		if not self.cancelSuperseded or running is None or 'nightly' in (running.buildtype, build.buildtype):
+			return
+		if build.isNewerThan(running):
+			running.cancel('superseded by revision ' + str(build.getRevision()))
+
+	def shutdown(self):
+		''' Cancel all running builds when the buildqueue stops. They stay recorded as running
+		in the store, so they are built again after a restart. '''
+		self.lock.acquire()
+		self.stopping = True
+		running = self.running.values()
 		self.lock.release()
+		for build in running:
+			build.cancel('the buildqueue stopped')
+
+	def cancel(self, name, reason, clean=False):
+		''' Cancel the running build of branch name, returns False if it is not being built '''
+		build = self.getRunning(name)
+		if build is None:
+			return False
+		build.cancel(reason, clean)
+		return True
 
-	def dequeue(self):
+	def discard(self, keep):
+		''' Drop the queued builds of branches that are not in keep, returns their names '''
 		self.lock.acquire()
-		item = self.get_nowait()
-		del self.builds[item[2].name]
-		self.current = item[2].name
+		self.mutex.acquire()
+		dropped = [item[2] for item in self.queue if item[2].name not in keep]
+		if dropped:
+			self.queue = [item for item in self.queue if item[2].name in keep]
+			heapq.heapify(self.queue)
+			self.not_full.notify()
+		self.mutex.release()
+		for build in dropped:
+			self.builds.pop(build.name, None)
+			self.notBefore.pop(build.name, None)
 		self.lock.release()
+
+		for build in dropped:
+			self.task_done()
+			if self.store:
+				self.store.finished(build)
+		return [build.name for build in dropped]
+
+	def supersede(self, build):
+		# Let the queued build of the branch build the revision of build instead, keeping its
+		# place in the queue. Returns False if there is no such build or it is not older.
+		# Must be called with self.lock held.
+		self.mutex.acquire()
+		try:
+			for i in range(len(self.queue)):
+				priority, sequence, queued = self.queue[i]
+				if queued.name != build.name or queued.buildtype == 'nightly':
+					continue
+				if not build.isNewerThan(queued):
+					return False
+				build.enqueuedTime = queued.enqueuedTime
+				build.storeId = queued.storeId
+				# the key does not change, so the heap stays valid
+				self.queue[i] = (priority, sequence, build)
+				return True
+			return False
+		finally:
+			self.mutex.release()
+
+	def debounce(self, build):
+		# must be called with self.lock held
+		if self.quietPeriod > 0 and build.buildtype != 'nightly':
+			self.notBefore[build.name] = time.time() + self.quietPeriod
+
+	def timeUntilRunnable(self):
+		# seconds until the first held back build becomes runnable, None if there is none.
+		# Must be called with self.lock held.
+		now = time.time()
+		waiting = [runnable for runnable in self.notBefore.values() if runnable > now]
+		if not waiting:
+			return None
+		return min(waiting) - now
+
+	def dequeue(self, stop_event):
+		''' Block until a build is available, returns None if stop_event got set while waiting '''
+		self.lock.acquire()
+		try:
+			item = self.takeRunnable()
+			while item is None:
+				if stop_event.isSet():
+					return None
+				# wake up in time for a build that is held back by its quiet period
+				self.available.wait(self.timeUntilRunnable())
+				item = self.takeRunnable()
+
+			self.startRunning(item)
+			return item
+		finally:
+			self.lock.release()
+
+	def lease(self):
+		''' Like dequeue for a remote agent, but returns None right away if nothing is runnable '''
+		self.lock.acquire()
+		try:
+			item = self.takeRunnable()
+			if item is not None:
+				self.startRunning(item)
+			return item
+		finally:
+			self.lock.release()
+
+	def startRunning(self, item):
+		# must be called with self.lock held
+		self.builds.pop(item[2].name, None)
+		self.notBefore.pop(item[2].name, None)
+		self.running[item[2].name] = item[2]
+		if self.store:
+			self.store.running(item[2])
+
+	def takeRunnable(self):
+		# Take the first build of a branch that is not being built already; two workers
+		# must never build the same branch at once as they would share the build directory.
+		# Builds within their quiet period are skipped as well.
+		# Must be called with self.lock held.
+		now = time.time()
+		self.mutex.acquire()
+		skipped = []
+		item = None
+		while self._qsize():
+			candidate = self._get()
+			if candidate[2].name in self.running:
+				skipped.append(candidate)
+			elif candidate[2].buildtype != 'nightly' and self.notBefore.get(candidate[2].name, 0) > now:
+				skipped.append(candidate)
+			else:
+				item = candidate
+				break
+		for candidate in skipped:
+			self._put(candidate)
+		if item is not None:
+			self.not_full.notify()
+		self.mutex.release()
 		return item
 
+	def wakeup(self):
+		''' Wake up all threads waiting in dequeue so they can check their stop event '''
+		self.lock.acquire()
+		self.available.notifyAll()
+		self.lock.release()
+
 	def getPlatform(self):
 		return self.platform
 
+	def getRunning(self, name):
+		self.lock.acquire()
+		build = self.running.get(name)
+		self.lock.release()
+		return build
+
+	def snapshot(self):
+		# only copy under the lock, the status server formats the copy at its leisure
+		self.lock.acquire()
+		queued = self.queue[:]
+		running = sorted(self.running.keys())
+		self.lock.release()
+
+		return {'platform': self.platform,
+			'queued': [elem[2].getName() for elem in sorted(queued)],
+			'running': running}
+
 	def asList(self):
+		snapshot = self.snapshot()
 		queueAsString = self.platform + ":\n"
-		for elem in self.queue:
-			queueAsString += elem[2].getName() + "\n"
+		for name in snapshot['queued']:
+			queueAsString += name + "\n"
 
-		queueAsString += " currently building: " + self.current + "\n"
+		queueAsString += " currently building: " + ", ".join(snapshot['running']) + "\n"
 
 		return queueAsString
 
 	def asHTML(self):
-			return self.list().replace("\n", "<br>")
+		snapshot = self.snapshot()
+		html = '<h2>' + cgi.escape(self.platform) + '</h2>\n<ol>\n'
+		for name in snapshot['queued']:
+			html += '<li>' + cgi.escape(name) + '</li>\n'
+		html += '</ol>\n<p>currently building: ' + cgi.escape(', '.join(snapshot['running'])) + '</p>\n'
+
+		return html
 
-	def setnoCurrent(self):
-		self.current = ""
+	def finished(self, build, retcode=None):
+		self.task_done()
+		if self.store and not self.stopping:
+			self.store.finished(build, retcode)
+
+		# the branch may be built again, wake up a worker that skipped it
+		self.lock.acquire()
+		del self.running[build.name]
+		self.available.notify()
+		self.lock.release()
 
 class Build:
 	def __init__(self, name, path, buildtype):
 		self.name = name
 		self.path = path
+		self.repospath = path # path relative to the repository, subclasses prefix self.path
 		self.buildtype = buildtype
 		self.newbuild = False
 		self.platform = ""
+		self.revision = 0
+		self.found = next(revisionsFound)
+		self.enqueuedTime = 0.0
+		self.storeId = None
+		self.tail = collections.deque(maxlen=200) # last lines of output of the running build
+		self.tailLock = threading.Lock()
+		self.process = None # the running ctest
+		self.processLock = threading.Lock()
+		self.cancelled = None # why the build got cancelled
+		self.cleanBuildDir = False # remove the build directory after cancelling
 
 	def setPlatform(self, platform):
 		self.platform = platform
 
+	def setRevision(self, revision):
+		self.revision = revision
+		self.found = next(revisionsFound)
+
+	def isNewerThan(self, other):
+		# subversion revisions are numbers, other revisions are newer if they were found later
+		if isinstance(self.revision, (int, long)) and isinstance(other.revision, (int, long)):
+			return self.revision > other.revision
+		return self.revision != other.revision and self.found > other.found
+
+	def retry(self):
+		# a copy to queue again, without the state of the run that got lost
+		build = copy.copy(self)
+		build.process = None
+		build.processLock = threading.Lock()
+		build.tailLock = threading.Lock()
+		build.tail = collections.deque(maxlen=200)
+		return build
+
+	def getRevision(self):
+		return self.revision
+
 	def getPlatform(self):
 		return self.platform
 
@@ -116,15 +485,10 @@ class Build:
 	def build(self):
 		pass
 
-class SubversionBuild(Build):
-	def __init__(self, name, path, buildtype):
-		Build.__init__(self, name, path, buildtype)
-		self.path = str(config.get('subversion', 'repository')) + path
-		self.buildscript = ""
-
-	def prebuild(self):
+	def exportBuildScript(self, client, scriptpath):
+		# export the stage 2 buildscript at self.revision through client and check whether it is a 'new' one
 		if(self.platform == ''):
-				log.warning("could not do prebuild for: " + name + " platform not set")
+				log.warning("could not do prebuild for: " + self.name + " platform not set")
 				return False
 
 		self.exportpath = os.path.normpath(os.path.expandvars(str(config.get('general','pivotdirectory')) + '/' + self.platform + '/buildscripts'))
@@ -138,48 +502,170 @@ class SubversionBuild(Build):
 			else:
 				return False
 
-		if(not subversionClient.exportBuildScript(self.name, self.path + '/' + str(config.get('general','buildscript')), self.buildscript)):
+		if(not client.exportBuildScript(self.name, scriptpath, self.buildscript, self.revision)):
 			return False
 
-		# check if this is a 'new' buildscript
-		for line in open(self.buildscript):
-			if "SERVERBUILD" in line:
-				self.newbuild = True
-				log.debug(self.platform + " " + self.name + " detected an new style buildscript")
-				break
+		# the cache already knows whether this is a 'new' buildscript
+		self.newbuild = buildScriptCache.isServerBuild(scriptpath, self.revision)
+		if self.newbuild is None:
+			self.newbuild = False
+			# check if this is a 'new' buildscript
+			for line in open(self.buildscript):
+				if "SERVERBUILD" in line:
+					self.newbuild = True
+					break
+
+		if self.newbuild:
+			log.debug(self.platform + " " + self.name + " detected an new style buildscript")
 
 		return True
 
-	def build(self):
-		# run the buildscript
+	def runBuildScript(self, argument):
+		# run the buildscript, returns the exit code of ctest or None if it could not be started
 		try:
 			command = "ctest"
 			argument1 = "--script"
-			argument2 = self.buildscript + ",platform=" + self.platform + ";branch=" + self.name + ";repo=" + self.path.replace('svn://','') + ";repotype=svn" + ";server" + ";" + self.buildtype
+			argument2 = self.buildscript + "," + argument
 			#log.debug("cmdline: " + command + ' ' + argument1 + argument2)
-			retcode = subprocess.call([command, argument1, argument2])
+			retcode = self.runCommand([command, argument1, argument2])
 
 			if retcode < 0:
 				log.warning(self.platform + " " + self.name + " was terminated by signal: " + str(-retcode))
-				return
 			else:
 				log.info(self.platform + " " + self.name + " returned: " + str(retcode))
-				return
+			return retcode
 		except OSError, e:
 			log.warning(self.platform + " " + self.name + " execution failed: " + str(e))
-			return
+			return None
+
+	def cancel(self, reason, clean=False):
+		# stop the build: kill ctest and all of its children if it runs, don't start it otherwise
+		self.processLock.acquire()
+		self.cancelled = reason
+		self.cleanBuildDir = self.cleanBuildDir or clean
+		process = self.process
+		self.processLock.release()
+
+		log.warning(self.platform + " " + self.name + " cancelled: " + reason)
+		if process is not None and process.poll() is None:
+			killProcessGroup(process)
+
+	def isCancelled(self):
+		return self.cancelled is not None
+
+	def getTail(self):
+		self.tailLock.acquire()
+		tail = list(self.tail)
+		self.tailLock.release()
+		return tail
+
+	def runCommand(self, command):
+		# Run command in its own process group with its output going to a per build log file
+		# and the in memory tail. Returns the exit code, negative when killed by a signal.
+		logpath = os.path.normpath(os.path.expandvars(str(config.get('general','pivotdirectory')) + '/' + self.platform + '/logs'))
+		try:
+			os.makedirs(logpath)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+		logfile = logpath + '/' + self.name + '.log'
+		rotateLog(logfile, getConfigInt('general', 'build_logs', 5))
+		timeout = getConfigInt('general', 'build_timeout', 4 * 3600)
+
+		# the platform copies of a build share attributes, give each run its own tail
+		self.tailLock = threading.Lock()
+		self.tail = collections.deque(maxlen=200)
+
+		output = open(logfile, 'wb')
+		try:
+			if sys.platform[:3] == 'win':
+				process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+			else:
+				process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+		except OSError:
+			output.close()
+			raise
+
+		# a cancel that came in before the process existed kills it right away
+		self.processLock.acquire()
+		self.process = process
+		cancelled = self.cancelled
+		self.processLock.release()
+		if cancelled:
+			killProcessGroup(process)
+
+		# the reader thread keeps the pipe drained, the worker only waits for it
+		reader = threading.Thread(target=self.readOutput, args=(process.stdout, output), name=self.platform + '-' + self.name + '-output')
+		reader.setDaemon(True)
+		reader.start()
+
+		# wait for ctest itself, children that detach from it may keep the output open
+		deadline = time.time() + timeout if timeout > 0 else None
+		try:
+			while process.poll() is None and (deadline is None or time.time() < deadline):
+				if reader.isAlive():
+					# returns as soon as the output gets closed, which is usually when ctest exits
+					reader.join(0.5)
+				else:
+					time.sleep(0.1)
+
+			if process.poll() is None:
+				log.warning(self.platform + " " + self.name + " did not finish within " + str(timeout) + " seconds - killing it")
+		finally:
+			# ctest runs in a session of its own, it must not outlive the worker waiting for it
+			if process.poll() is None:
+				killProcessGroup(process)
+
+		retcode = process.wait()
+		self.processLock.acquire()
+		self.process = None
+		self.processLock.release()
+		# children that escaped the process group may still hold the pipe, don't wait for them
+		reader.join(1)
+		return retcode
+
+	def readOutput(self, pipe, output):
+		for line in iter(pipe.readline, ''):
+			output.write(line)
+			self.tailLock.acquire()
+			self.tail.append(line.rstrip('\r\n'))
+			self.tailLock.release()
+		pipe.close()
+		output.close()
+
+class SubversionBuild(Build):
+	def __init__(self, name, path, buildtype):
+		Build.__init__(self, name, path, buildtype)
+		self.path = str(config.get('subversion', 'repository')) + path
+		self.buildscript = ""
+
+	def prebuild(self):
+		return self.exportBuildScript(subversionClient, self.path + '/' + str(config.get('general','buildscript')))
+
+	def build(self):
+		return self.runBuildScript("platform=" + self.platform + ";branch=" + self.name + ";repo=" + self.path.replace('svn://','') + ";repotype=svn" + ";server" + ";" + self.buildtype)
 
 class GitBuild(Build):
+	''' Build of a git branch, path is the name of the branch and the revision the sha of its head
+
+	The buildscript gets the name of the build directory as branch, like for subversion,
+	and the name of the git branch as ref. '''
 	def __init__(self, name, path, buildtype):
 		Build.__init__(self, name, path, buildtype)
-		self.path = str(config.get('git', 'repository')) + path
+		self.repository = str(config.get('git', 'repository'))
 		self.buildscript = ""
 
 	def prebuild(self):
-		pass
+		if gitClient is None:
+			log.warning("could not do prebuild for: " + self.name + " git is not available")
+			return False
+		return self.exportBuildScript(gitClient, str(config.get('general','buildscript')))
 
 	def build(self):
-		pass
+		return self.runBuildScript("platform=" + self.platform + ";branch=" + self.name + ";ref=" + self.path + ";repo=" + self.repository + ";revision=" + str(self.revision) + ";repotype=git" + ";server" + ";" + self.buildtype)
+
+# the kinds of builds by class name, as they are recorded in the build store and sent to agents
+buildClasses = {'SubversionBuild': SubversionBuild, 'GitBuild': GitBuild}
 
 class QueueThreadClass(threading.Thread):
 	def __init__(self, queue, name):
@@ -190,37 +676,303 @@ class QueueThreadClass(threading.Thread):
 
 	def stop(self):
 		self.stop_event.set()
+		self.queue.wakeup()
 
 	def run(self):
 		log.debug("%s started at time: %s" % (self.name, datetime.now()))
 
 		while not self.stop_event.isSet():
-			# returned value consists of: priority, sortorder, build object
-			if not self.queue.empty():
-				item = self.queue.dequeue()
+			# returned value consists of: priority, sequence number, build object
+			# blocks until a build gets enqueued or the thread is stopped
+			item = self.queue.dequeue(self.stop_event)
+			if item is None:
+				break
 
-				if(not item[2].prebuild()):
-					self.queue.task_done()
-					self.queue.setnoCurrent()
-					continue
+			labels = (('platform', self.queue.getPlatform()), ('branch', item[2].getName()))
+			started = time.time()
+			metrics.observe('buildqueue_queue_wait_seconds', labels, started - item[2].enqueuedTime)
+
+			prebuilt = item[2].prebuild()
+			metrics.observe('buildqueue_prebuild_seconds', labels, time.time() - started)
+			if(not prebuilt or item[2].isCancelled()):
+				self.queue.finished(item[2])
+				continue
+
+			if(item[2].isNewBuild()):
+				started = time.time()
+				retcode = item[2].build()
+				recordResult(self.queue, item[2], retcode, time.time() - started)
+				if item[2].isCancelled() and item[2].cleanBuildDir:
+					buildDirRemover.remove(self.queue.getPlatform(), buildDirectory(self.queue.getPlatform(), item[2].getName()))
+				self.queue.finished(item[2], retcode)
+				continue
+			else:
+				log.debug(self.name + " " + item[2].getName() + " detected an old style buildscript - skipping")
+				self.queue.finished(item[2])
+
+def recordResult(bqueue, build, retcode, duration):
+	# account for a build that ran, by a worker or an agent
+	labels = (('platform', bqueue.getPlatform()), ('branch', build.getName()))
+	if build.isCancelled():
+		# an aborted run says nothing about how long the branch takes to build
+		metrics.increment('buildqueue_cancelled_total', labels)
+	else:
+		bqueue.recordDuration(build.getName(), duration)
+		metrics.observe('buildqueue_build_seconds', labels, duration)
+	metrics.increment('buildqueue_builds_total', labels + (('exitcode', str(retcode)),))
+
+class AgentThreadClass(threading.Thread):
+	''' Worker of a build agent: leases the builds of its platform from the coordinator,
+	sends heartbeats while building and reports the exit code when done '''
+	def __init__(self, coordinator, platform, name, poll=5, heartbeat=30):
+		threading.Thread.__init__(self)
+		self.coordinator = coordinator # (host, port)
+		self.platform = platform
+		self.name = name
+		self.poll = poll
+		self.heartbeat = heartbeat
+		self.stop_event = threading.Event()
 
-				if(item[2].isNewBuild()):
-					item[2].build()
-					self.queue.task_done()
-					self.queue.setnoCurrent()
-					continue
-				else:
-					log.debug(self.name + " " + item[2].getName() + " detected an old style buildscript - skipping")
-					self.queue.task_done()
-					self.queue.setnoCurrent()
+	def stop(self):
+		self.stop_event.set()
+
+	def request(self, command):
+		# one short connection per request, returns the reply line or None if the coordinator can't be reached
+		try:
+			conn = socket.create_connection(self.coordinator, 30)
+			try:
+				conn.sendall(command + '\n')
+				reply = ''
+				while '\n' not in reply:
+					data = conn.recv(4096)
+					if not data:
+						break
+					reply += data
+			finally:
+				conn.close()
+		except socket.error, e:
+			log.warning(self.name + ': could not reach the coordinator: ' + str(e))
+			return None
+		return reply.split('\n', 1)[0]
+
+	def run(self):
+		log.debug("%s started at time: %s" % (self.name, datetime.now()))
+
+		while not self.stop_event.isSet():
+			reply = self.request('lease ' + self.platform + ' ' + self.name)
+			if reply is None or not reply.startswith('build '):
+				self.stop_event.wait(self.poll)
+				continue
+			self.runBuild(json.loads(reply[len('build '):]))
+
+	def runBuild(self, job):
+		lease = job['lease']
+		if job['kind'] not in buildClasses:
+			log.warning(self.name + ': can not build ' + job['name'] + ', unknown kind of build: ' + job['kind'])
+			self.report(lease, None, 0)
+			return
+
+		build = buildClasses[job['kind']](str(job['name']), str(job['path']), str(job['buildtype']))
+		build.setPlatform(self.platform)
+		build.setRevision(job['revision'])
+		log.info(self.name + ': building ' + build.getName() + ' ' + build.buildtype + ' at ' + str(build.getRevision()))
+
+		finished = threading.Event()
+		heartbeats = threading.Thread(target=self.sendHeartbeats, args=(lease, build, finished), name=self.name + '-heartbeat')
+		heartbeats.setDaemon(True)
+		heartbeats.start()
+
+		# only the coordinator polls the remote, the mirror of the agent may not have the commit yet
+		if isinstance(build, GitBuild) and gitClient is not None and not buildScriptCache.contains(str(config.get('general','buildscript')), build.getRevision()):
+			gitClient.fetch([build.path])
+
+		started = time.time()
+		retcode = None
+		if build.prebuild() and not build.isCancelled():
+			if build.isNewBuild():
+				retcode = build.build()
 			else:
-				time.sleep(30)
+				log.debug(self.name + " " + build.getName() + " detected an old style buildscript - skipping")
+		duration = time.time() - started
+
+		finished.set()
+		heartbeats.join()
+		if build.isCancelled() and build.cleanBuildDir:
+			log.info(self.name + ': removing build directory of ' + build.getName())
+			shutil.rmtree(buildDirectory(self.platform, build.getName()), True)
+		self.report(lease, retcode, duration)
+
+	def sendHeartbeats(self, lease, build, finished):
+		while not finished.wait(self.heartbeat):
+			reply = self.request('heartbeat ' + lease)
+			if reply in ('cancel', 'cancel clean'):
+				build.cancel('cancelled by the coordinator', reply == 'cancel clean')
+			elif reply == 'unknown':
+				log.warning(self.name + ': the coordinator no longer knows the lease on ' + build.getName())
+
+	def report(self, lease, retcode, duration):
+		# the result is worth a few retries, otherwise the lease expires and the build is done again
+		for attempt in range(5):
+			if self.request('result %s %s %.1f' % (lease, retcode, duration)) is not None:
+				return
+			self.stop_event.wait(self.poll)
+
+class LeaseTable():
+	''' Builds handed out to remote agents
+
+	A lease that gets no heartbeat for timeout seconds is considered lost with its agent,
+	the build is then put back on its queue. '''
+	def __init__(self, timeout=300):
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.leases = {} # lease id -> [queue, build, agent, time of the last heartbeat]
+		self.nextCheck = 0
+
+	def grant(self, platform, agent):
+		# returns the lease id and the build for the agent, None if there is nothing to build
+		for bqueue in BuildQueues[:]:
+			if bqueue.getPlatform() != platform:
+				continue
+			item = bqueue.lease()
+			if item is None:
+				return None
+			lease = uuid.uuid4().hex
+			self.lock.acquire()
+			self.leases[lease] = [bqueue, item[2], agent, time.time()]
+			self.lock.release()
+			metrics.observe('buildqueue_queue_wait_seconds', (('platform', platform), ('branch', item[2].getName())), time.time() - item[2].enqueuedTime)
+			log.info(agent + ' leased ' + platform + ' ' + item[2].getName())
+			return lease, item[2]
+		return None
+
+	def heartbeat(self, lease):
+		# returns 'ok', 'cancel' when the agent has to abort the build ('cancel clean' when it
+		# has to remove the build directory as well) or 'unknown'
+		self.lock.acquire()
+		try:
+			if lease not in self.leases:
+				return 'unknown'
+			self.leases[lease][3] = time.time()
+			build = self.leases[lease][1]
+			if not build.isCancelled():
+				return 'ok'
+			return 'cancel clean' if build.cleanBuildDir else 'cancel'
+		finally:
+			self.lock.release()
+
+	def complete(self, lease, retcode, duration):
+		self.lock.acquire()
+		entry = self.leases.pop(lease, None)
+		self.lock.release()
+		if entry is None:
+			return False
+
+		bqueue, build, agent, lastHeartbeat = entry
+		log.info(agent + ' finished ' + bqueue.getPlatform() + ' ' + build.getName() + ': ' + str(retcode))
+		if retcode is not None:
+			recordResult(bqueue, build, retcode, duration)
+		bqueue.finished(build, retcode)
+		return True
+
+	def expire(self):
+		now = time.time()
+		if now < self.nextCheck:
+			return
+		self.nextCheck = now + 10
+
+		self.lock.acquire()
+		expired = [(lease, entry) for lease, entry in self.leases.items() if now - entry[3] > self.timeout]
+		for lease, entry in expired:
+			del self.leases[lease]
+		self.lock.release()
+
+		for lease, (bqueue, build, agent, lastHeartbeat) in expired:
+			bqueue.finished(build)
+			if build.isCancelled():
+				log.warning(agent + ' stopped sending heartbeats for ' + bqueue.getPlatform() + ' ' + build.getName() + ', which was cancelled')
+				continue
+			# a newer revision of the branch that got queued meanwhile stays in place
+			log.warning(agent + ' stopped sending heartbeats for ' + bqueue.getPlatform() + ' ' + build.getName() + ' - queueing it again')
+			try:
+				bqueue.enqueue(build.retry())
+			except Queue.Full:
+				log.warning(bqueue.getPlatform() + ' queue full, skipping: ' + build.getName())
+
+	def asList(self):
+		self.lock.acquire()
+		entries = [(entry[1].getPlatform(), entry[1].getName(), entry[2]) for entry in self.leases.values()]
+		self.lock.release()
+		return ''.join([platform + ' ' + name + ' on ' + agent + '\n' for platform, name, agent in sorted(entries)])
+
+class RemoverThreadClass(threading.Thread):
+	''' Removes build directories in the background, so the polling loop doesn't wait for the disk '''
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.name = 'remover'
+		self.queue = Queue.Queue()
+		self.lock = threading.Lock()
+		self.pending = set() # paths queued for removal, so a directory is only queued once
+
+	def remove(self, platform, path):
+		self.lock.acquire()
+		try:
+			if path in self.pending:
+				return
+			self.pending.add(path)
+		finally:
+			self.lock.release()
+		self.queue.put((platform, path))
+
+	def stop(self):
+		self.queue.put(None)
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+
+			platform, path = item
+			try:
+				log.info(platform + ': removing build directory: ' + path)
+				# moving it to the trash is instant, the reaper removes it in the background
+				if not trashCan.trash(path):
+					shutil.rmtree(path)
+			except OSError, e:
+				log.warning(platform + ': failed to remove build directory: ' + path + ' :' + str(e))
+
+			self.lock.acquire()
+			self.pending.discard(path)
+			self.lock.release()
+
+class StatusConnection():
+	''' Buffers of a single client of the status server '''
+	def __init__(self, conn):
+		self.conn = conn
+		self.inbuffer = ''
+		self.outbuffer = ''
+		self.closeWhenSent = False
 
 class SocketThreadClass(threading.Thread):
+	''' Serves the state of the buildqueues to any number of clients at once
+
+	Commands are newline terminated: 'list' answers in plain text, 'html' and 'json' in
+	the respective format and 'metrics' in the prometheus text format. 'tail <platform>
+	<branch>' returns the last lines of output of a running build. A browser pointed at
+	the port gets the html page, or the json document for /json, the metrics for /metrics
+	and the tail of a build for /tail/<platform>/<branch>.
+
+	Build agents use 'lease <platform> <agent>', answered with 'build <json>' or 'none',
+	'heartbeat <lease>' and 'result <lease> <exit code> <seconds>', answered with 'ok' or
+	'unknown', or 'cancel' on a heartbeat when the agent has to stop the build ('cancel clean'
+	when it has to remove the build directory as well). 'agents' lists the builds that are
+	leased out. 'cancel <platform> <branch> [clean]' stops a running build, on every platform
+	for '*', and with 'clean' removes its build directory as well. '''
 	def __init__(self, port):
 		threading.Thread.__init__(self)
 		self.port = port
 		self.stop_event = threading.Event()
+		self.connections = {}
 
 	def stop(self):
 		self.stop_event.set()
@@ -230,80 +982,622 @@ class SocketThreadClass(threading.Thread):
 		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		s.bind(('', self.port))
-		s.listen(1)
+		s.listen(16)
+		s.setblocking(0)
 
 		while not self.stop_event.isSet():
+			# agents that went silent give their builds back
+			leases.expire()
+
+			writers = [conn for conn, client in self.connections.items() if client.outbuffer]
 			try:
-				conn, addr = s.accept()
-				while 1:
-					data = conn.recv(1024)
-
-					if data:
-						if "list" in data:
-							for bqueue in BuildQueues[:]:
-								log.debug(bqueue.asList())
-								conn.sendall(bqueue.asList())
-					else:
-						break
-			except socket.error, e:
+				# wake up regularly to check the stop event
+				readable, writable, failed = select.select([s] + self.connections.keys(), writers, [], 1.0)
+			except select.error, e:
 				log.warning('failure on socket: ' + str(e))
+				continue
 
-			#try:
-			#	doc = HTMLgen.SimpleDocument(title="BuildQueue")
-			#	for bqueue in BuildQueues[:]:
-			#		doc.append(bqueue.asHTML())
+			for conn in readable:
+				if conn is s:
+					self.accept(s)
+				else:
+					self.receive(conn)
 
-			#	conn.sendall(str(doc))
-			#	doc = ""
-			#except socket.timeout:
-			#	break
+			for conn in writable:
+				if conn in self.connections:
+					self.send(conn)
 
+		for conn in self.connections.keys():
+			self.close(conn)
+		s.close()
 
-			conn.close()
+	def accept(self, s):
+		try:
+			conn, addr = s.accept()
+			conn.setblocking(0)
+			self.connections[conn] = StatusConnection(conn)
+		except socket.error, e:
+			log.warning('failure on socket: ' + str(e))
+
+	def receive(self, conn):
+		client = self.connections[conn]
+		try:
+			data = conn.recv(1024)
+		except socket.error, e:
+			log.warning('failure on socket: ' + str(e))
+			self.close(conn)
+			return
+
+		if not data:
+			self.close(conn)
+			return
+
+		client.inbuffer += data
+		while '\n' in client.inbuffer and not client.closeWhenSent:
+			line, client.inbuffer = client.inbuffer.split('\n', 1)
+			client.outbuffer += self.reply(client, line.strip())
 
-# Wrapper class to implement blocking locks
+		# after the request line of a browser only its headers follow, they are no commands
+		if client.closeWhenSent:
+			client.inbuffer = ''
+			return
+
+		# clients that send a bare command without a newline get answered too
+		if client.inbuffer.strip() in ('list', 'html', 'json', 'metrics'):
+			client.outbuffer += self.reply(client, client.inbuffer.strip())
+			client.inbuffer = ''
+
+		# don't let a client without newlines grow the buffer forever
+		if len(client.inbuffer) > 4096:
+			client.inbuffer = ''
+
+	def send(self, conn):
+		client = self.connections[conn]
+		try:
+			sent = conn.send(client.outbuffer)
+			client.outbuffer = client.outbuffer[sent:]
+		except socket.error, e:
+			log.warning('failure on socket: ' + str(e))
+			self.close(conn)
+			return
+
+		if not client.outbuffer and client.closeWhenSent:
+			self.close(conn)
+
+	def close(self, conn):
+		del self.connections[conn]
+		try:
+			conn.close()
+		except socket.error:
+			pass
+
+	def reply(self, client, command):
+		if command.startswith('GET '):
+			# answer browsers with a single http response
+			client.closeWhenSent = True
+			if command.split()[1].startswith('/metrics'):
+				return httpResponse('text/plain; version=0.0.4', statusAsMetrics())
+			if command.split()[1].startswith('/tail/'):
+				return httpResponse('text/plain', statusAsTail(command.split()[1].split('/')[2:4]))
+			if command.split()[1].startswith('/json'):
+				return httpResponse('application/json', statusAsJSON())
+			return httpResponse('text/html', statusAsHTML())
+
+		if command.startswith('lease '):
+			return agentLease(command.split()[1:3])
+		elif command.startswith('heartbeat '):
+			return leases.heartbeat(command.split()[1]) + '\n'
+		elif command.startswith('cancel '):
+			return statusCancel(command.split()[1:])
+		elif command.startswith('result '):
+			return agentResult(command.split()[1:4])
+		elif command.startswith('tail '):
+			return statusAsTail(command.split()[1:3])
+		elif command == 'agents':
+			return leases.asList()
+		elif command == 'html':
+			return statusAsHTML()
+		elif command == 'json':
+			return statusAsJSON() + '\n'
+		elif command == 'metrics':
+			return statusAsMetrics()
+		# the prefix commands come first, their arguments may contain 'list'
+		elif "list" in command:
+			return statusAsList()
+		return ''
+
+# Wrapper class around a pool of subversion clients. A pysvn.Client may only be used by
+# one thread at a time, so every call checks a client out of the pool and returns it
+# afterwards; the pool size limits the number of concurrent server connections.
 class SubversionClient():
 	def __init__(self):
-		self.client = pysvn.Client()
-		self.client.callback_get_login = self.get_login
 		self.svnRepository = str(config.get('subversion', 'repository'))
-		self.lock = threading.Lock()
+		try:
+			self.poolSize = max(1, config.getint('subversion', 'connections'))
+		except ConfigParser.Error:
+			self.poolSize = 4
+
+		self.pool = Queue.Queue()
+		for i in range(self.poolSize):
+			client = pysvn.Client()
+			client.callback_get_login = self.get_login
+			self.pool.put(client)
+
 
 	# callback needed for the subversion client
-	def get_login( realm, username, may_save ):
+	def get_login(self, realm, username, may_save):
 		"""callback implementation for Subversion login"""
 		return True, config.get('subversion', 'user'), config.get('subversion', 'password'), True
 
 	def getBranchList(self):
 		log.debug('get branchlist in:')
-		self.lock.acquire()
+		client = self.pool.get()
 		branchList = []
 
 		# find branch names (returns a list of tuples)
 		try:
-			branchList = self.client.list(self.svnRepository + '/branches', depth=pysvn.depth.immediates)
+			branchList = client.list(self.svnRepository + '/branches', depth=pysvn.depth.immediates)
 		except pysvn.ClientError, e:
 			log.warning('Failed to get the branchlist: ' + str(e))
 
-		self.lock.release()
+		self.pool.put(client)
 		log.debug('get branchlist out:')
 		return branchList
 
-	def exportBuildScript(self, name, path, buildscript):
+	def getLastChangedRevision(self, path):
+		# the created_rev of a directory entry is the last revision that changed anything below it
+		client = self.pool.get()
+		revision = None
+
+		try:
+			entries = client.list(self.svnRepository + path, depth=pysvn.depth.empty)
+			revision = entries[0][0].created_rev.number
+		except pysvn.ClientError, e:
+			log.warning('Failed to get the last changed revision of ' + path + ': ' + str(e))
+
+		self.pool.put(client)
+		return revision
+
+	def fetchBuildScript(self, name, path, revision):
+		# returns the contents of the buildscript at the given revision, or None on failure
+		if revision:
+			svnRevision = pysvn.Revision(pysvn.opt_revision_kind.number, revision)
+		else:
+			svnRevision = pysvn.Revision(pysvn.opt_revision_kind.head)
+
 		log.debug('get buildscript in: ' + path)
-		self.lock.acquire()
-		# export the buildscript that will perform the actual build of the branch
+		client = self.pool.get()
 		try:
-			self.client.export(path, buildscript, force=True, recurse=False)
+			content = client.cat(path, revision=svnRevision)
 		except pysvn.ClientError, e:
 			log.warning("Failed to export the buildscript for " + name + ':' + str(e))
-			self.lock.release()
+			content = None
+		self.pool.put(client)
+		log.debug('get buildscript out: ' + path)
+
+		# buildscripts are the same for every platform, keep them keyed on (path, revision)
+		if revision and content is not None:
+			buildScriptCache.store(path, revision, content)
+
+		return content
+
+	def exportBuildScript(self, name, path, buildscript, revision=None):
+		# export the buildscript that will perform the actual build of the branch
+		if revision and buildScriptCache.export(path, revision, buildscript):
+			log.debug('get buildscript from cache: ' + path + '@' + str(revision))
+			return True
+
+		content = self.fetchBuildScript(name, path, revision)
+		if content is None:
+			return False
+
+		try:
+			f = open(buildscript, 'wb')
+			f.write(content)
+			f.close()
+		except IOError, e:
+			log.warning("Failed to write the buildscript for " + name + ':' + str(e))
 			return False
 
-		self.lock.release()
-		log.debug('get buildscript out: ' + path)
 		return True
 
+	def exportBuildScripts(self, scripts):
+		# fetch the buildscripts for a batch of (name, path, revision) tuples into the cache,
+		# using every connection of the pool, so the platform queues don't each export them
+		jobs = Queue.Queue()
+		for script in scripts:
+			jobs.put(script)
+
+		def fetch():
+			while True:
+				try:
+					name, path, revision = jobs.get_nowait()
+				except Queue.Empty:
+					return
+				if not revision or not buildScriptCache.contains(path, revision):
+					self.fetchBuildScript(name, path, revision)
+
+		fetchers = [threading.Thread(target=fetch) for i in range(min(self.poolSize, len(scripts)))]
+		for fetcher in fetchers:
+			fetcher.start()
+		for fetcher in fetchers:
+			fetcher.join()
+
+# Wrapper around a bare mirror of the git repository. The heads are polled with a single
+# ls-remote, only heads that moved are fetched, and buildscripts are read from the mirror
+# with cat-file, so there is never a checkout. The mirror leaves the blobs on the server
+# until a buildscript needs one.
+class GitClient():
+	def __init__(self):
+		self.repository = str(config.get('git', 'repository'))
+		try:
+			self.mirror = config.get('git', 'mirror')
+		except ConfigParser.Error:
+			self.mirror = ''
+		if not self.mirror:
+			self.mirror = str(config.get('general','pivotdirectory')) + '/git-mirror.git'
+		self.mirror = os.path.normpath(os.path.expandvars(self.mirror))
+		# the workers of an agent fetch into the same mirror
+		self.fetchLock = threading.Lock()
+
+		if not os.path.exists(self.mirror):
+			log.info('Creating the git mirror in ' + self.mirror)
+			self.repo = git.Repo.clone_from(self.repository, self.mirror, bare=True, filter='blob:none')
+		else:
+			self.repo = git.Repo(self.mirror)
+
+	def getHeads(self):
+		# returns a dictionary of branch -> sha of its head, None if the remote could not be reached
+		try:
+			output = git.Git().ls_remote('--heads', self.repository)
+		except git.GitCommandError, e:
+			log.warning('Failed to list the git heads: ' + str(e))
+			return None
+
+		heads = {}
+		for line in output.split('\n'):
+			if '\trefs/heads/' in line:
+				sha, ref = line.split('\t', 1)
+				heads[ref[len('refs/heads/'):]] = sha
+		return heads
+
+	def fetch(self, branches):
+		# bring the given branches of the mirror up to date, returns False on failure
+		self.fetchLock.acquire()
+		try:
+			# in chunks to stay below the command line length limits
+			for i in range(0, len(branches), 500):
+				self.repo.git.fetch(self.repository, *['+refs/heads/' + branch + ':refs/heads/' + branch for branch in branches[i:i + 500]])
+		except git.GitCommandError, e:
+			log.warning('Failed to fetch the git heads: ' + str(e))
+			return False
+		finally:
+			self.fetchLock.release()
+		return True
+
+	def fetchBuildScript(self, name, path, revision):
+		# returns the contents of the buildscript in commit revision, or None on failure
+		log.debug('get buildscript in: ' + path + '@' + revision)
+		try:
+			# the raw bytes, git.cat_file would return decoded text without the last newline
+			content = (self.repo.commit(revision).tree / path).data_stream.read()
+		except (git.GitCommandError, git.BadName, git.BadObject, ValueError, KeyError), e:
+			log.warning("Failed to export the buildscript for " + name + ':' + str(e))
+			return None
+		log.debug('get buildscript out: ' + path + '@' + revision)
+
+		# the same script is on many branches, the cache stores it once
+		buildScriptCache.store(path, revision, content)
+		return content
+
+	def exportBuildScript(self, name, path, buildscript, revision):
+		# export the buildscript that will perform the actual build of the branch
+		if buildScriptCache.export(path, revision, buildscript):
+			log.debug('get buildscript from cache: ' + path + '@' + revision)
+			return True
+
+		content = self.fetchBuildScript(name, path, revision)
+		if content is None:
+			return False
+
+		try:
+			f = open(buildscript, 'wb')
+			f.write(content)
+			f.close()
+		except IOError, e:
+			log.warning("Failed to write the buildscript for " + name + ':' + str(e))
+			return False
+
+		return True
+
+	def exportBuildScripts(self, scripts):
+		# read the buildscripts for a batch of (name, path, revision) tuples into the cache
+		for name, path, revision in scripts:
+			if not buildScriptCache.contains(path, revision):
+				self.fetchBuildScript(name, path, revision)
+
+class BuildScriptCache():
+	''' Content addressed store of exported buildscripts
+
+	Scripts are stored once per distinct content, named after their sha1. The index maps a
+	(repository path, last changed revision) to the content, together with whether the script
+	is a SERVERBUILD one. The least recently used scripts are removed once the store grows
+	beyond maxSize bytes, the least recently used index entries beyond maxEntries, as every
+	commit adds one while the branches mostly share a few scripts. The index is written at
+	most every saveInterval seconds. '''
+	def __init__(self, path, maxSize, maxEntries=10000, saveInterval=60):
+		self.path = path
+		self.maxSize = maxSize
+		self.maxEntries = maxEntries
+		self.saveInterval = saveInterval
+		self.lock = threading.Lock()
+		self.saveLock = threading.Lock() # serializes writing the index, which is done outside self.lock
+		self.index = collections.OrderedDict() # (repository path, revision) -> sha1 of the content, least recently used first
+		self.blobs = {} # sha1 -> [size, last used, is a SERVERBUILD script]
+		self.dirty = False
+		self.lastSave = time.time()
+
+		try:
+			os.makedirs(self.path)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				log.warning('Could not create the buildscript cache: ' + str(e))
+
+		try:
+			f = open(self.path + '/index', 'rb')
+			index, self.blobs = pickle.load(f)
+			f.close()
+			self.index = collections.OrderedDict(index)
+		except (IOError, pickle.UnpicklingError, EOFError, ValueError):
+			pass
+
+		# drop entries of which the script went missing
+		for digest in self.blobs.keys():
+			if not os.path.exists(self.blobPath(digest)):
+				del self.blobs[digest]
+		for key, digest in self.index.items():
+			if digest not in self.blobs:
+				del self.index[key]
+
+	def lookup(self, path, revision):
+		# the digest of a script, marking the entry as used. Must be called with self.lock held.
+		digest = self.index.pop((path, revision), None)
+		if digest is not None:
+			self.index[(path, revision)] = digest
+		return digest
+
+	def blobPath(self, digest):
+		return self.path + '/' + digest + '.cmake'
+
+	def contains(self, path, revision):
+		self.lock.acquire()
+		found = (path, revision) in self.index
+		self.lock.release()
+		return found
+
+	def isServerBuild(self, path, revision):
+		# memoized SERVERBUILD detection, None if the script is not in the cache
+		self.lock.acquire()
+		try:
+			digest = self.lookup(path, revision)
+			if digest is None:
+				return None
+			return self.blobs[digest][2]
+		finally:
+			self.lock.release()
+
+	def export(self, path, revision, destination):
+		# copy a cached script to destination, returns False if it is not in the cache
+		self.lock.acquire()
+		try:
+			digest = self.lookup(path, revision)
+			if digest is None:
+				return False
+			try:
+				shutil.copyfile(self.blobPath(digest), destination)
+			except IOError, e:
+				log.warning('Could not copy ' + path + '@' + str(revision) + ' from the buildscript cache: ' + str(e))
+				return False
+			self.blobs[digest][1] = time.time()
+			return True
+		finally:
+			self.lock.release()
+
+	def store(self, path, revision, content):
+		digest = hashlib.sha1(content).hexdigest()
+		self.lock.acquire()
+		try:
+			if digest not in self.blobs:
+				try:
+					f = open(self.blobPath(digest) + '.tmp', 'wb')
+					f.write(content)
+					f.close()
+					os.rename(self.blobPath(digest) + '.tmp', self.blobPath(digest))
+				except (IOError, OSError), e:
+					log.warning('Could not store ' + path + '@' + str(revision) + ' in the buildscript cache: ' + str(e))
+					return
+				self.blobs[digest] = [len(content), time.time(), "SERVERBUILD" in content]
+			else:
+				self.blobs[digest][1] = time.time()
+
+			self.index.pop((path, revision), None)
+			self.index[(path, revision)] = digest
+			self.evict()
+			self.dirty = True
+		finally:
+			self.lock.release()
+		self.save()
+
+	def evict(self):
+		# remove the least recently used index entries and scripts until both fit, must be called with self.lock held
+		while len(self.index) > self.maxEntries:
+			self.index.popitem(last=False)
+		# scripts that are no longer in the index can't be found anymore
+		unused = set(self.blobs.keys()) - set(self.index.values())
+
+		totalSize = sum([blob[0] for blob in self.blobs.values()])
+		for digest in sorted(self.blobs.keys(), key=lambda digest: self.blobs[digest][1]):
+			if totalSize <= self.maxSize:
+				break
+			totalSize -= self.blobs[digest][0]
+			unused.add(digest)
+
+		for digest in unused:
+			del self.blobs[digest]
+			try:
+				os.remove(self.blobPath(digest))
+			except OSError, e:
+				log.warning('Could not remove ' + digest + ' from the buildscript cache: ' + str(e))
+
+		if unused:
+			for key, digest in self.index.items():
+				if digest in unused:
+					del self.index[key]
+
+	def save(self, force=False):
+		# write the index if it changed, with force also within saveInterval of the last write
+		self.saveLock.acquire()
+		try:
+			# only copy under the lock, export doesn't have to wait for the pickling
+			self.lock.acquire()
+			if not self.dirty or (not force and time.time() < self.lastSave + self.saveInterval):
+				self.lock.release()
+				return
+			index = self.index.items()
+			blobs = dict([(digest, list(blob)) for digest, blob in self.blobs.items()])
+			self.dirty = False
+			self.lastSave = time.time()
+			self.lock.release()
+
+			try:
+				f = open(self.path + '/index.tmp', 'wb')
+				pickle.dump((index, blobs), f, pickle.HIGHEST_PROTOCOL)
+				f.close()
+				os.rename(self.path + '/index.tmp', self.path + '/index')
+			except (IOError, OSError), e:
+				log.warning('Could not write the buildscript cache index: ' + str(e))
+		finally:
+			self.saveLock.release()
+
+class BuildStore():
+	''' Crash safe record of queued, running and finished builds and of the revision state
+
+	Everything is kept in a sqlite database. Changes are handed to a writer thread that
+	commits them in batches, so recording a build never waits for a disk sync. The values
+	and revisions are also kept in memory, reads don't have to wait for the writer. '''
+	def __init__(self, filename, interval=1.0):
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.pending = Queue.Queue()
+		self.connection = sqlite3.connect(filename, check_same_thread=False)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute('PRAGMA synchronous=FULL')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS builds (id INTEGER PRIMARY KEY, kind TEXT, platform TEXT, name TEXT, path TEXT, buildtype TEXT, revision INTEGER, state TEXT, enqueued REAL, finished REAL, exitcode INTEGER)')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS revisions (name TEXT PRIMARY KEY, revision INTEGER)')
+		self.connection.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+		# keep a week of finished builds around for reference
+		self.connection.execute('DELETE FROM builds WHERE state = ? AND finished < ?', ('finished', time.time() - 7 * 24 * 3600))
+		self.connection.commit()
+
+		self.values = dict(self.connection.execute('SELECT key, value FROM settings').fetchall())
+		self.revisions = dict(self.connection.execute('SELECT name, revision FROM revisions').fetchall())
+		lastId = self.connection.execute('SELECT MAX(id) FROM builds').fetchone()[0]
+		self.ids = itertools.count((lastId or 0) + 1)
+
+		self.writer = threading.Thread(target=self.write, name='buildstore')
+		self.writer.setDaemon(True)
+		self.writer.start()
+
+	def write(self):
+		while True:
+			statements = [self.pending.get()]
+			# collect whatever else arrives in the meantime into the same transaction
+			time.sleep(self.interval)
+			try:
+				while True:
+					statements.append(self.pending.get_nowait())
+			except Queue.Empty:
+				pass
+
+			# flush requests are queued as (None, event)
+			flushed = [statement[1] for statement in statements if statement[0] is None]
+			self.lock.acquire()
+			try:
+				for statement in statements:
+					if statement[0] is not None:
+						self.connection.execute(*statement)
+				self.connection.commit()
+			except sqlite3.Error, e:
+				log.warning('Could not write the build store: ' + str(e))
+			self.lock.release()
+
+			for event in flushed:
+				event.set()
+
+	def flush(self):
+		# wait until everything recorded so far is on disk
+		event = threading.Event()
+		self.pending.put((None, event))
+		event.wait()
+
+	def queued(self, platform, build):
+		if build.storeId is None:
+			build.storeId = self.ids.next()
+			self.pending.put(('INSERT INTO builds (id, kind, platform, name, path, buildtype, revision, state, enqueued) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+				(build.storeId, build.__class__.__name__, platform, build.name, build.repospath, build.buildtype, build.revision, 'queued', build.enqueuedTime)))
+		else:
+			self.pending.put(('UPDATE builds SET state = ? WHERE id = ?', ('queued', build.storeId)))
+
+	def superseded(self, build):
+		self.pending.put(('UPDATE builds SET path = ?, revision = ? WHERE id = ?', (build.repospath, build.revision, build.storeId)))
+
+	def running(self, build):
+		self.pending.put(('UPDATE builds SET state = ? WHERE id = ?', ('running', build.storeId)))
+
+	def replaced(self, storeId):
+		# the row of a restored build that took over an older queued build, the row of that one records it now
+		self.pending.put(('UPDATE builds SET state = ?, finished = ? WHERE id = ?', ('finished', time.time(), storeId)))
+
+	def finished(self, build, exitcode=None):
+		self.pending.put(('UPDATE builds SET state = ?, finished = ?, exitcode = ? WHERE id = ?', ('finished', time.time(), exitcode, build.storeId)))
+
+	def unfinished(self):
+		# builds that were queued or running, in the order they were queued
+		self.lock.acquire()
+		rows = self.connection.execute('SELECT id, kind, platform, name, path, buildtype, revision FROM builds WHERE state IN (?, ?) ORDER BY id', ('queued', 'running')).fetchall()
+		self.lock.release()
+		return rows
+
+	def getRevisions(self):
+		self.lock.acquire()
+		revisions = dict(self.revisions)
+		self.lock.release()
+		return revisions
+
+	def setRevision(self, name, revision):
+		self.lock.acquire()
+		self.revisions[name] = revision
+		self.lock.release()
+		self.pending.put(('INSERT OR REPLACE INTO revisions (name, revision) VALUES (?, ?)', (name, revision)))
+
+	def forgetRevision(self, name):
+		self.lock.acquire()
+		self.revisions.pop(name, None)
+		self.lock.release()
+		self.pending.put(('DELETE FROM revisions WHERE name = ?', (name,)))
+
+	def getValue(self, key):
+		self.lock.acquire()
+		value = self.values.get(key)
+		self.lock.release()
+		return value
+
+	def setValue(self, key, value):
+		self.lock.acquire()
+		self.values[key] = value
+		self.lock.release()
+		self.pending.put(('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value)))
+
 class Builds():
 	def __init__(self, lastNightlyTime):
 		self.lastNightlyTime = lastNightlyTime
@@ -312,17 +1606,53 @@ class Builds():
 		print "process default builds"
 
 class SubversionBuilds(Builds):
-	def __init__(self, lastNightlyTime):
+	def __init__(self, lastNightlyTime, builtRevisions):
 		Builds.__init__(self, lastNightlyTime)
+		# last changed revision per branch that has been handed to the buildqueues
+		self.builtRevisions = builtRevisions
+		# names of the build directories that were kept at the last reconciliation
+		self.keptNames = None
+		self.enqueuedCount = 0
+		self.skippedCount = 0
+
+	def isChanged(self, name, revision):
+		# only build branches that got a commit since the last time they were queued
+		if revision is None or self.builtRevisions.get(name) == revision:
+			self.skippedCount += 1
+			metrics.increment('buildqueue_enqueue_skipped_total')
+			return False
+		return True
+
+	def enqueue(self, builds):
+		# fetch the buildscripts of all builds in one go, the platform queues then find them in the cache
+		buildscript = str(config.get('general','buildscript'))
+		subversionClient.exportBuildScripts([(build.getName(), build.path + '/' + buildscript, build.getRevision()) for build in builds])
+
+		for build in builds:
+			if not addToBuildQueues(build):
+				continue
+			if build.getRevision() is not None:
+				self.builtRevisions[build.getName()] = build.getRevision()
+				buildStore.setRevision(build.getName(), build.getRevision())
+			self.enqueuedCount += 1
+			metrics.increment('buildqueue_enqueued_total')
 
 	def processBuilds(self):
+		builds = []
+
 		# Nightly
 		if checkNightlyTimestamp(self.lastNightlyTime, datetime.now()):
-			addToBuildQueues(SubversionBuild('trunk', '/trunk', 'nightly'))
+			build = SubversionBuild('trunk', '/trunk', 'nightly')
+			build.setRevision(subversionClient.getLastChangedRevision('/trunk'))
+			builds.append(build)
 			self.lastNightlyTime = getNightlyTimestamp()
 			log.info('Inserted nightly')
 		else:
-			addToBuildQueues(SubversionBuild('trunk', '/trunk', 'experimental'))
+			revision = subversionClient.getLastChangedRevision('/trunk')
+			if self.isChanged('trunk', revision):
+				build = SubversionBuild('trunk', '/trunk', 'experimental')
+				build.setRevision(revision)
+				builds.append(build)
 
 		branchList = subversionClient.getBranchList()
 
@@ -330,48 +1660,236 @@ class SubversionBuilds(Builds):
 		if branchList:
 			# skip the first entry in the list as it is /branches (the directory in the repo)
 			for branch in branchList[1:]:
-				log.debug('Found branch: ' +  os.path.basename(branch[0].repos_path) + ' created at revision ' + str(branch[0].created_rev.number))
-				addToBuildQueues(SubversionBuild(os.path.basename(branch[0].repos_path), branch[0].repos_path, 'experimental'))
-
-			# clean up builddirectories for which no branch exists anymore
-			for queue in BuildQueues[:]:
-				builddirpath = os.path.normpath(os.path.expandvars(str(config.get('general','pivotdirectory')) + '/' + queue.getPlatform() + '/build'))
-				builddirList = os.listdir(builddirpath)
-				for branch in branchList[1:]:
-					try:
-						builddirList.remove(os.path.basename(branch[0].repos_path))
-					except:
-						log.info(queue.getPlatform() + ': no builddir exists for ' + os.path.basename(branch[0].repos_path))
+				name = os.path.basename(branch[0].repos_path)
+				revision = branch[0].created_rev.number
+				# with thousands of branches only the changed ones are worth a log line and a build object
+				if self.isChanged(name, revision):
+					log.debug('Found branch: ' + name + ' last changed at revision ' + str(revision))
+					build = SubversionBuild(name, branch[0].repos_path, 'experimental')
+					build.setRevision(revision)
+					builds.append(build)
+
+		if builds:
+			self.enqueue(builds)
 
-				try:
-					builddirList.remove('trunk')
-				except:
-					log.info(queue.getPlatform() + ': no builddir exists for trunk')
+		if branchList:
+			# forget the revisions of branches that have been removed from the repository
+			branchNames = set([os.path.basename(branch[0].repos_path) for branch in branchList[1:]])
+			branchNames.add('trunk')
+			for name in self.builtRevisions.keys():
+				if name not in branchNames:
+					del self.builtRevisions[name]
+					buildStore.forgetRevision(name)
+
+			# the build directories only need to be looked at when the set of branches changed
+			keep = branchNames | gitBuilds.getBuildNames()
+			if keep != self.keptNames:
+				self.reconcile(keep)
+				self.keptNames = keep
+
+		log.debug('builds enqueued: ' + str(self.enqueuedCount) + ', skipped without new commits: ' + str(self.skippedCount))
+
+	def reconcile(self, keep):
+		# clean up builddirectories for which no branch exists anymore
+		for queue in BuildQueues[:]:
+			# queued builds of removed branches would only create their build directory again
+			for name in queue.discard(keep):
+				log.info(queue.getPlatform() + ': dropped the queued build of removed branch ' + name)
+			# a running one would only fail once its directory is removed
+			for name in set(queue.snapshot()['running']) - keep:
+				queue.cancel(name, 'branch removed')
+
+			builddirpath = os.path.normpath(os.path.expandvars(str(config.get('general','pivotdirectory')) + '/' + queue.getPlatform() + '/build'))
+			try:
+				builddirs = set(os.listdir(builddirpath))
+			except OSError, e:
+				log.warning(queue.getPlatform() + ': could not list the build directories: ' + str(e))
+				continue
 
-				for builddir in builddirList[:]:
-					try:
-						log.info(queue.getPlatform() + ': removing build directory for: ' + builddirpath + '/' + builddir)
-						shutil.rmtree(builddirpath + '/' + builddir)
-					except OSError, e:
-						log.warning(queue.getPlatform() + ': failed to remove build directory for: ' + builddirpath + '/' + builddir + ' :' + str(e))
+			builddirs.discard(trashcan.TRASH)
+			log.debug(queue.getPlatform() + ': ' + str(len(keep - builddirs)) + ' branches without a build directory')
+			for builddir in sorted(builddirs - keep):
+				buildDirRemover.remove(queue.getPlatform(), builddirpath + '/' + builddir)
 
 class GitBuilds(Builds):
-	def __init__(self, lastNightlyTime):
+	def __init__(self, lastNightlyTime, builtHeads):
 		Builds.__init__(self, lastNightlyTime)
+		# sha of the head per branch that has been handed to the buildqueues
+		self.builtHeads = builtHeads
+		# branches on the remote at the last poll, including those the queues had no room for
+		self.branches = set(builtHeads.keys())
+		self.enqueuedCount = 0
+		self.skippedCount = 0
+
+	def getBuildNames(self):
+		# names of the build directories of the git branches
+		return set([buildName(branch) for branch in self.branches])
 
 	def processBuilds(self):
-		print "processed Git builds"
+		if gitClient is None:
+			return
+
+		heads = gitClient.getHeads()
+		# may have failed if server could not be reached
+		if heads is None:
+			return
+		self.branches = set(heads.keys())
+
+		moved = [branch for branch, sha in heads.items() if self.builtHeads.get(branch) != sha]
+		self.skippedCount += len(heads) - len(moved)
+		metrics.increment('buildqueue_enqueue_skipped_total', value=len(heads) - len(moved))
+
+		changed = False
+		# the mirror needs the commits to read the buildscripts from
+		if moved and gitClient.fetch(moved):
+			builds = []
+			for branch in sorted(moved):
+				log.debug('Found git branch: ' + branch + ' at ' + heads[branch])
+				build = GitBuild(buildName(branch), branch, 'experimental')
+				build.setRevision(heads[branch])
+				builds.append(build)
+
+			buildscript = str(config.get('general','buildscript'))
+			gitClient.exportBuildScripts([(build.getName(), buildscript, build.getRevision()) for build in builds])
+
+			for build in builds:
+				if not addToBuildQueues(build):
+					continue
+				self.builtHeads[build.path] = build.getRevision()
+				self.enqueuedCount += 1
+				metrics.increment('buildqueue_enqueued_total')
+				changed = True
+
+		# forget the heads of branches that have been removed
+		for branch in self.builtHeads.keys():
+			if branch not in heads:
+				del self.builtHeads[branch]
+				changed = True
+
+		if changed:
+			buildStore.setValue('githeads', json.dumps(self.builtHeads))
+
+		log.debug('git builds enqueued: ' + str(self.enqueuedCount) + ', skipped without new commits: ' + str(self.skippedCount))
+
+def buildName(branch):
+	# git branches may contain slashes, the name is used for build directories and logs.
+	# Replacing them would make a/b and a-b the same build, so those get a hash of the branch.
+	if '/' not in branch:
+		return 'git-' + branch
+	return 'git-' + branch.replace('/', '-') + '-' + hashlib.sha1(branch).hexdigest()[:8]
 
 ##################################################################################
+def statusAsList():
+	return ''.join([bqueue.asList() for bqueue in BuildQueues[:]])
+
+def statusAsHTML():
+	body = ''.join([bqueue.asHTML() for bqueue in BuildQueues[:]])
+	return '<html><head><title>BuildQueue</title></head><body>\n' + body + '</body></html>\n'
+
+def statusAsJSON():
+	return json.dumps([bqueue.snapshot() for bqueue in BuildQueues[:]])
+
+def statusAsMetrics():
+	gauges = []
+	for bqueue in BuildQueues[:]:
+		snapshot = bqueue.snapshot()
+		labels = (('platform', bqueue.getPlatform()),)
+		gauges.append(('buildqueue_queued_builds', labels, len(snapshot['queued'])))
+		gauges.append(('buildqueue_running_builds', labels, len(snapshot['running'])))
+	return metrics.asText(gauges)
+
+def statusAsTail(arguments):
+	if len(arguments) != 2:
+		return 'usage: tail <platform> <branch>\n'
+
+	platform, name = arguments
+	for bqueue in BuildQueues[:]:
+		if bqueue.getPlatform() == platform:
+			build = bqueue.getRunning(name)
+			if build is not None:
+				return ''.join([line + '\n' for line in build.getTail()])
+	return name + ' is not being built for ' + platform + '\n'
+
+def statusCancel(arguments):
+	if len(arguments) not in (2, 3) or (len(arguments) == 3 and arguments[2] != 'clean'):
+		return 'usage: cancel <platform|*> <branch> [clean]\n'
+
+	platform, name = arguments[:2]
+	reply = ''
+	for bqueue in BuildQueues[:]:
+		if platform in ('*', bqueue.getPlatform()):
+			if bqueue.cancel(name, 'cancelled on request', len(arguments) == 3):
+				reply += 'cancelled ' + bqueue.getPlatform() + ' ' + name + '\n'
+	return reply or name + ' is not being built for ' + platform + '\n'
+
+def agentLease(arguments):
+	if len(arguments) != 2:
+		return 'usage: lease <platform> <agent>\n'
+	granted = leases.grant(*arguments)
+	if granted is None:
+		return 'none\n'
+	lease, build = granted
+	return 'build ' + json.dumps({'lease': lease, 'kind': build.__class__.__name__, 'name': build.name, 'path': build.repospath,
+		'buildtype': build.buildtype, 'revision': build.getRevision()}) + '\n'
+
+def agentResult(arguments):
+	if len(arguments) != 3:
+		return 'usage: result <lease> <exit code> <seconds>\n'
+	lease, retcode, duration = arguments
+	try:
+		retcode = None if retcode == 'None' else int(retcode)
+		duration = float(duration)
+	except ValueError:
+		return 'usage: result <lease> <exit code> <seconds>\n'
+	return 'ok\n' if leases.complete(lease, retcode, duration) else 'unknown\n'
+
+def httpResponse(contentType, body):
+	return 'HTTP/1.0 200 OK\r\nContent-Type: ' + contentType + '\r\nContent-Length: ' + str(len(body)) + '\r\nConnection: close\r\n\r\n' + body
+
 def addToBuildQueues(build):
+	# returns False if a queue was full, the build then has to be offered again on the next poll
+	accepted = True
 	for bqueue in BuildQueues[:]:
 		try:
 			buildcopy = copy.copy(build)
 			buildcopy.setPlatform(bqueue.getPlatform())
-			# for now just using one priority. The second argument is used for sorting within a priority level
-			bqueue.enqueue((1, 1, buildcopy))
+			bqueue.enqueue(buildcopy)
 		except Queue.Full:
-			log.warning(bqueue.name + ' queue full, skipping: ' + buildcopy.name)
+			log.warning(bqueue.getPlatform() + ' queue full, skipping: ' + buildcopy.name)
+			accepted = False
+	return accepted
+
+def buildDirectory(platform, name):
+	return os.path.normpath(os.path.expandvars(str(config.get('general','pivotdirectory')) + '/' + platform + '/build/' + name))
+
+def getConfigInt(section, option, default):
+	try:
+		return config.getint(section, option)
+	except ConfigParser.Error:
+		return default
+
+def rotateLog(logfile, count):
+	# keep the logs of the last count builds as logfile.1 .. logfile.<count - 1>
+	for i in range(count - 1, 0, -1):
+		previous = logfile + ('.' + str(i - 1) if i > 1 else '')
+		if os.path.exists(previous):
+			try:
+				# windows can't rename over an existing file
+				if os.path.exists(logfile + '.' + str(i)):
+					os.remove(logfile + '.' + str(i))
+				os.rename(previous, logfile + '.' + str(i))
+			except OSError, e:
+				log.warning('Failed to rotate ' + previous + ': ' + str(e))
+
+def killProcessGroup(process):
+	# kill the process and all of its children
+	try:
+		if sys.platform[:3] == 'win':
+			subprocess.call(['taskkill', '/F', '/T', '/PID', str(process.pid)])
+		else:
+			os.killpg(process.pid, signal.SIGKILL)
+	except OSError, e:
+		log.warning('Failed to kill process ' + str(process.pid) + ': ' + str(e))
 
 def writeDefaultConfig():
 	try:
@@ -382,12 +1900,45 @@ def writeDefaultConfig():
 		defaultConfig.write('# loglevel may be one of: debug, info, warning, error, critical\n')
 		defaultConfig.write('loglevel   : \n')
 		defaultConfig.write('port : \n')
+		defaultConfig.write('# number of builds that may run in parallel per platform, 0 to leave all builds to agents (default 1)\n')
+		defaultConfig.write('workers_per_platform : 1\n')
+		defaultConfig.write('# size in MB of the cache of exported buildscripts (default 16)\n')
+		defaultConfig.write('buildscriptcache_size : 16\n')
+		defaultConfig.write('# revisions of buildscripts the cache keeps track of (default 10000)\n')
+		defaultConfig.write('buildscriptcache_entries : 10000\n')
+		defaultConfig.write('# seconds by which nightly and trunk builds overtake queued branch builds\n')
+		defaultConfig.write('nightly_boost : 3600\n')
+		defaultConfig.write('trunk_boost : 1800\n')
+		defaultConfig.write('# build the branch with the shortest expected build time first (default no)\n')
+		defaultConfig.write('shortest_first : no\n')
+		defaultConfig.write('# seconds a branch has to go without new commits before it gets built, 0 to build right away (default 60)\n')
+		defaultConfig.write('quiet_period : 60\n')
+		defaultConfig.write('# cancel a running build when a newer revision of its branch gets queued (default yes)\n')
+		defaultConfig.write('cancel_superseded : yes\n')
+		defaultConfig.write('# seconds after which a build gets killed, 0 to never kill (default 14400)\n')
+		defaultConfig.write('build_timeout : 14400\n')
+		defaultConfig.write('# number of output logs kept per branch and platform (default 5)\n')
+		defaultConfig.write('build_logs : 5\n')
+		defaultConfig.write('# files per second removed from the trash of removed build directories, 0 for no limit (default 2000)\n')
+		defaultConfig.write('trashrate : 2000\n')
+		defaultConfig.write('# comma separated platforms to queue builds for (default: the ones of this machine)\n')
+		defaultConfig.write('platforms : \n')
+		defaultConfig.write('# seconds without a heartbeat after which a build leased by an agent is queued again (default 300)\n')
+		defaultConfig.write('lease_timeout : 300\n')
+		defaultConfig.write('[agent]\n')
+		defaultConfig.write('# used with --agent <host>:<port>: seconds between asking for a build and between heartbeats\n')
+		defaultConfig.write('poll : 5\n')
+		defaultConfig.write('heartbeat : 30\n')
 		defaultConfig.write('[subversion]\n')
 		defaultConfig.write('repository : <repository url>\n')
 		defaultConfig.write('user       : <username>\n')
 		defaultConfig.write('password   : <password>\n')
+		defaultConfig.write('# number of parallel connections to the subversion server (default 4)\n')
+		defaultConfig.write('connections : 4\n')
 		defaultConfig.write('[git]\n')
 		defaultConfig.write('repository : <repository url>\n')
+		defaultConfig.write('# bare mirror the buildscripts are read from (default <pivotdirectory>/git-mirror.git)\n')
+		defaultConfig.write('mirror : \n')
 		defaultConfig.close()
 		print 'Default configuration written as: ' + defaultConfig.name
 	except IOError, e:
@@ -397,29 +1948,98 @@ def writeDefaultConfig():
 
 def getNightlyTimestamp():
 	lastNightlyTime = datetime(date.today().year, date.today().month, date.today().day, 1, 0, 0)
-	lastNightlyFile = 'buildqueue.nightlytimestamp'
+	value = buildStore.getValue('nightlytimestamp')
 
-	if os.path.exists(lastNightlyFile):
+	if value is not None:
 		try:
-			f = open(lastNightlyFile, 'r+b')
-			lastNightlyTime = pickle.load(f)
-			f.close()
-		except IOError, e:
-			log.warning("Could not read nightly timestamp file, using today")
+			lastNightlyTime = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+		except ValueError, e:
+			log.warning("Could not read nightly timestamp, using today")
 	else:
 		updateNightlyTimestamp(lastNightlyTime)
 
 	return lastNightlyTime
 
 def updateNightlyTimestamp(lastNightlyTime):
-	lastNightlyFile = 'buildqueue.nightlytimestamp'
+	buildStore.setValue('nightlytimestamp', lastNightlyTime.strftime('%Y-%m-%d %H:%M:%S'))
 
+def importPickledState(store):
+	# take over the state files written by earlier versions of the buildqueue
+	if os.path.exists('buildqueue.nightlytimestamp') and store.getValue('nightlytimestamp') is None:
+		try:
+			f = open('buildqueue.nightlytimestamp', 'rb')
+			store.setValue('nightlytimestamp', pickle.load(f).strftime('%Y-%m-%d %H:%M:%S'))
+			f.close()
+			os.remove('buildqueue.nightlytimestamp')
+		except (IOError, OSError, pickle.UnpicklingError, EOFError), e:
+			log.warning("Could not import the nightly timestamp file: " + str(e))
+
+	if os.path.exists('buildqueue.revisions') and not store.getRevisions():
+		try:
+			f = open('buildqueue.revisions', 'rb')
+			for name, revision in pickle.load(f).items():
+				store.setRevision(name, revision)
+			f.close()
+			os.remove('buildqueue.revisions')
+		except (IOError, OSError, pickle.UnpicklingError, EOFError), e:
+			log.warning("Could not import the built revisions file: " + str(e))
+
+def restoreBuilds(store):
+	# put the builds that were queued or running when the daemon stopped back on their queues
+	queues = dict([(bqueue.getPlatform(), bqueue) for bqueue in BuildQueues])
+
+	for storeId, kind, platform, name, path, buildtype, revision in store.unfinished():
+		if platform not in queues or kind not in buildClasses:
+			continue
+		build = buildClasses[kind](str(name), str(path), str(buildtype))
+		build.setPlatform(str(platform))
+		build.setRevision(revision)
+		build.storeId = storeId
+		try:
+			if queues[platform].enqueue(build):
+				log.info('Restored ' + platform + ' ' + name + ' ' + buildtype + ' build')
+			else:
+				# the branch is queued at this revision already
+				store.replaced(storeId)
+		except Queue.Full:
+			log.warning(platform + ' queue full, could not restore: ' + name)
+
+def getPlatforms():
+	# the platforms to build for, from the configuration or else the ones this machine can build
 	try:
-		f = open(lastNightlyFile, 'wb')
-		pickle.dump(lastNightlyTime, f)
-		f.close()
-	except IOError, e:
-		log.warning("Could not write nightly timestamp file, using today")
+		platforms = [platform.strip() for platform in config.get('general', 'platforms').split(',') if platform.strip()]
+	except ConfigParser.Error:
+		platforms = []
+	if platforms:
+		return platforms
+
+	if sys.platform[:5] == 'linux':
+		return ['linux-arm', 'linux-x86']
+	elif sys.platform[:3] == 'win':
+		return ['windows-x86']
+	return []
+
+def runAgent(coordinator):
+	# build for the buildqueue at coordinator until killed
+	host, port = coordinator.rsplit(':', 1)
+	platforms = getPlatforms()
+	if not platforms:
+		log.warning("Unknown platform, don't know which builds to lease")
+		sys.exit()
+
+	Threads = []
+	for platform in platforms:
+		for worker in range(max(1, getConfigInt('general', 'workers_per_platform', 1))):
+			Threads.append(AgentThreadClass((host, int(port)), platform, socket.gethostname() + '-' + platform + '-' + str(worker),
+				getConfigInt('agent', 'poll', 5), getConfigInt('agent', 'heartbeat', 30)))
+
+	for thread in Threads:
+		thread.setDaemon(True)
+		thread.start()
+
+	# join with a timeout so KeyboardInterrupt gets through
+	while True:
+		time.sleep(1)
 
 def checkNightlyTimestamp(lastNightlyTime, currentTime):
 	delta = currentTime - lastNightlyTime
@@ -442,8 +2062,13 @@ def main():
 		writeDefaultConfig()
 		sys.exit()
 
+	agent = None
+	if '--agent' in sys.argv[1:-1]:
+		agent = sys.argv[sys.argv.index('--agent') + 1]
+
 	try:
-		config.get('general', 'port')
+		if agent is None:
+			config.get('general', 'port')
 		config.get('general', 'buildscript')
 		config.get('general', 'loglevel')
 		config.get('general', 'pivotdirectory')
@@ -477,30 +2102,99 @@ def main():
 
 	log.debug('starting main loop')
 
+	try:
+		buildScriptCacheSize = config.getint('general', 'buildscriptcache_size')
+	except ConfigParser.Error:
+		buildScriptCacheSize = 16
+
+	global buildScriptCache
+	buildScriptCache = BuildScriptCache(os.path.normpath(os.path.expandvars(str(config.get('general','pivotdirectory')) + '/buildscript-cache')), buildScriptCacheSize * 1024 * 1024,
+		getConfigInt('general', 'buildscriptcache_entries', 10000))
+
 	global subversionClient
 	subversionClient = SubversionClient()
 
+	global gitClient
+	try:
+		gitClient = GitClient()
+	except (git.GitCommandError, git.InvalidGitRepositoryError, git.NoSuchPathError), e:
+		log.warning('Git builds are disabled, the mirror is not available: ' + str(e))
+		gitClient = None
+
+	if agent is not None:
+		log.info('Building for the buildqueue at ' + agent)
+		runAgent(agent)
+		return
+
+	global trashCan
+	trashCan = trashcan.TrashCan(getConfigInt('general', 'trashrate', 2000), log)
+	trashCan.start()
+
+	global buildStore
+	buildStore = BuildStore('buildqueue.db')
+	importPickledState(buildStore)
+
 	QueueLen    = 48 # just a stab at a sane queue length
 	global BuildQueues
 	BuildQueues = []
 
-	if sys.platform[:5] == 'linux':
-		BuildQueues.append(BuildQueue(QueueLen, 'linux-arm'))
-		BuildQueues.append(BuildQueue(QueueLen, 'linux-x86'))
-	elif sys.platform[:3] == 'win':
-		BuildQueues.append(BuildQueue(QueueLen, 'windows-x86'))
-	else:
+	# seconds a nightly or trunk build may overtake branch builds that were queued earlier
+	boosts = {'nightly': 3600, 'trunk': 1800}
+	for buildtype in boosts.keys():
+		try:
+			boosts[buildtype] = config.getint('general', buildtype + '_boost')
+		except ConfigParser.Error:
+			pass
+
+	try:
+		shortestFirst = config.getboolean('general', 'shortest_first')
+	except ConfigParser.Error:
+		shortestFirst = False
+
+	quietPeriod = getConfigInt('general', 'quiet_period', 60)
+	try:
+		cancelSuperseded = config.getboolean('general', 'cancel_superseded')
+	except ConfigParser.Error:
+		cancelSuperseded = True
+
+	for platform in getPlatforms():
+		BuildQueues.append(BuildQueue(QueueLen, platform, boosts, shortestFirst, buildStore, quietPeriod, cancelSuperseded))
+	if not BuildQueues:
 		log.warning("Unknown platform, don't know which buildqueue to start")
 		sys.exit()
 
+	# resume where a previous run left off
+	restoreBuilds(buildStore)
+	for queue in BuildQueues[:]:
+		builddirpath = os.path.normpath(os.path.expandvars(str(config.get('general','pivotdirectory')) + '/' + queue.getPlatform() + '/build'))
+		try:
+			trashCan.adopt(trashcan.findTrash(builddirpath + '/trunk'))
+		except OSError:
+			pass
+
+	try:
+		workersPerPlatform = config.getint('general', 'workers_per_platform')
+	except ConfigParser.Error:
+		workersPerPlatform = 1
+
+	# builds leased by remote agents
+	global leases
+	leases = LeaseTable(getConfigInt('general', 'lease_timeout', 300))
+
 	Threads = []
-	# Start build queue threads
+	# Start build queue threads, each worker of a platform can build a different branch
 	for queue in BuildQueues[:]:
-		Threads.append(QueueThreadClass(queue, queue.getPlatform()))
+		for worker in range(max(0, workersPerPlatform)):
+			Threads.append(QueueThreadClass(queue, queue.getPlatform() + '-' + str(worker)))
 
 	# Start socket to show buildqueues
 	Threads.append(SocketThreadClass(config.getint('general', 'port')))
 
+	# Build directories of removed branches are removed in the background
+	global buildDirRemover
+	buildDirRemover = RemoverThreadClass()
+	Threads.append(buildDirRemover)
+
 	for thread in Threads[:]:
 		try:
 			# let threads be killed when main is killed
@@ -512,13 +2206,27 @@ def main():
 			return
 
 	lastNightlyTime = getNightlyTimestamp()
-	subversionBuilds = SubversionBuilds(lastNightlyTime)
-	gitBuilds = GitBuilds(lastNightlyTime)
+	subversionBuilds = SubversionBuilds(lastNightlyTime, buildStore.getRevisions())
+	global gitBuilds
+	try:
+		builtHeads = dict([(str(branch), str(sha)) for branch, sha in json.loads(buildStore.getValue('githeads') or '{}').items()])
+	except ValueError:
+		builtHeads = {}
+	gitBuilds = GitBuilds(lastNightlyTime, builtHeads)
 
-	while True:
-		subversionBuilds.processBuilds()
-		gitBuilds.processBuilds()
-		time.sleep(30)
+	# a normal stop unwinds like an interrupt, so what is pending gets written
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+	try:
+		while True:
+			subversionBuilds.processBuilds()
+			gitBuilds.processBuilds()
+			time.sleep(30)
+	finally:
+		# the builds run in sessions of their own, a stop of the daemon does not reach them
+		for queue in BuildQueues[:]:
+			queue.shutdown()
+		buildScriptCache.save(True)
+		buildStore.flush()
 
 	#stacktracer.trace_stop()
 
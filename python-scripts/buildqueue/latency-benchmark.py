@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Small benchmark for the buildqueue worker threads. It feeds a synthetic stream of
+# commits into a BuildQueue and measures the time between enqueueing a build and the
+# moment a worker starts building it. The builds themselves only sleep, so no
+# subversion server or ctest is needed.
+#
+# usage: latency-benchmark.py [commits] [commits per second] [build seconds] [branches] [workers] [quiet period]
+
+import sys
+import time
+import random
+import logging
+import buildqueue
+
+class SyntheticBuild(buildqueue.Build):
+	def __init__(self, name, buildtime, latencies):
+		buildqueue.Build.__init__(self, name, '/branches/' + name, 'experimental')
+		self.newbuild = True
+		self.buildtime = buildtime
+		self.latencies = latencies
+		self.enqueued = 0.0
+
+	def prebuild(self):
+		return True
+
+	def build(self):
+		self.latencies.append(time.time() - self.enqueued)
+		time.sleep(self.buildtime)
+
+def percentile(values, fraction):
+	if not values:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+	commits   = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+	rate      = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+	buildtime = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+	branches  = int(sys.argv[4]) if len(sys.argv) > 4 else 50
+	workers   = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+	quiet     = float(sys.argv[6]) if len(sys.argv) > 6 else 0.0
+
+	logging.basicConfig(level=logging.WARNING)
+	buildqueue.log = logging.getLogger()
+
+	latencies = []
+	queue = buildqueue.BuildQueue(0, 'benchmark', quietPeriod=quiet)
+	threads = []
+	for i in range(workers):
+		threads.append(buildqueue.QueueThreadClass(queue, queue.getPlatform() + '-' + str(i)))
+		threads[-1].setDaemon(True)
+		threads[-1].start()
+
+	skipped = 0
+	for i in range(commits):
+		# exponential inter-arrival times give a poisson commit stream
+		time.sleep(random.expovariate(rate))
+		build = SyntheticBuild('branch%d' % random.randint(1, branches), buildtime, latencies)
+		build.setRevision(i + 1)
+		build.enqueued = time.time()
+		if not queue.enqueue(build):
+			skipped += 1
+
+	# let the workers drain what is left
+	while not queue.empty() or queue.running:
+		time.sleep(0.01)
+	for thread in threads:
+		thread.stop()
+		thread.join()
+
+	print 'commits: %d, builds started: %d, skipped as already queued: %d, queued builds moved to a newer revision: %d' % (commits, len(latencies), skipped,
+		buildqueue.metrics.counters.get(('buildqueue_superseded_total', (('platform', 'benchmark'),)), 0))
+	if latencies:
+		print 'enqueue to build start (ms): mean %.2f p50 %.2f p95 %.2f max %.2f' % (
+			1000 * sum(latencies) / len(latencies),
+			1000 * percentile(latencies, 0.50),
+			1000 * percentile(latencies, 0.95),
+			1000 * max(latencies))
+
+##################################################################################
+if __name__ == '__main__':
+	main()
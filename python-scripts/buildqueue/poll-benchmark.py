@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# Benchmark for the polling loop of the buildqueue with many branches. It creates a build
+# directory per branch for every platform in a temporary pivotdirectory and times
+# SubversionBuilds.processBuilds against a fake subversion server: a poll without changes,
+# and a poll after a branch got removed. For comparison it also times the reconciliation
+# as it was done before, on every poll with a list remove per branch.
+#
+# usage: poll-benchmark.py [branches] [platforms]
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import ConfigParser
+from datetime import datetime
+import buildqueue
+
+class Revision:
+	def __init__(self, number):
+		self.number = number
+
+class Entry:
+	def __init__(self, path, revision):
+		self.repos_path = path
+		self.created_rev = Revision(revision)
+
+class FakeSubversionClient:
+	''' Answers like pysvn without a server, every branch last changed at revision 1 '''
+	def __init__(self, branches):
+		self.branches = branches
+
+	def getLastChangedRevision(self, path):
+		return 1
+
+	def getBranchList(self):
+		return [(Entry('/branches', 1), None)] + [(Entry('/branches/' + name, 1), None) for name in self.branches]
+
+def previousReconcile(pivot, platforms, branchList):
+	# the reconciliation as it ran on every poll before
+	for platform in platforms:
+		builddirpath = pivot + '/' + platform + '/build'
+		builddirList = os.listdir(builddirpath)
+		for branch in branchList[1:]:
+			try:
+				builddirList.remove(os.path.basename(branch[0].repos_path))
+			except:
+				pass
+		try:
+			builddirList.remove('trunk')
+		except:
+			pass
+
+def timePoll(builds, repeats=5):
+	best = None
+	for i in range(repeats):
+		start = time.time()
+		builds.processBuilds()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def main():
+	branches  = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	platforms = ['platform' + str(i) for i in range(int(sys.argv[2]) if len(sys.argv) > 2 else 3)]
+
+	logging.basicConfig(level=logging.WARNING)
+	buildqueue.log = logging.getLogger()
+
+	pivot = tempfile.mkdtemp()
+	try:
+		names = ['branch%d' % i for i in range(branches)]
+		for platform in platforms:
+			for name in names + ['trunk']:
+				os.makedirs(pivot + '/' + platform + '/build/' + name)
+
+		buildqueue.config = ConfigParser.SafeConfigParser()
+		buildqueue.config.add_section('general')
+		buildqueue.config.set('general', 'pivotdirectory', pivot)
+		buildqueue.config.set('general', 'buildscript', 'stage2.cmake')
+		buildqueue.config.add_section('subversion')
+		buildqueue.config.set('subversion', 'repository', 'svn://benchmark')
+		buildqueue.buildStore = buildqueue.BuildStore(pivot + '/buildqueue.db')
+		buildqueue.BuildQueues = [buildqueue.BuildQueue(0, platform) for platform in platforms]
+		buildqueue.subversionClient = FakeSubversionClient(names)
+		buildqueue.gitClient = None
+		buildqueue.gitBuilds = buildqueue.GitBuilds(None, {})
+		buildqueue.trashCan = buildqueue.trashcan.TrashCan()
+		buildqueue.trashCan.start()
+		buildqueue.buildDirRemover = buildqueue.RemoverThreadClass()
+		buildqueue.buildDirRemover.setDaemon(True)
+		buildqueue.buildDirRemover.start()
+
+		# everything has been built already, so the polls only reconcile
+		revisions = dict([(name, 1) for name in names + ['trunk']])
+		builds = buildqueue.SubversionBuilds(datetime.now(), revisions)
+
+		start = time.time()
+		builds.processBuilds()
+		print '%d branches, %d platforms' % (branches, len(platforms))
+		print 'first poll (reconciles):         %8.1f ms' % (1000 * (time.time() - start))
+		print 'poll without changes:            %8.1f ms' % (1000 * timePoll(builds))
+
+		removed = names.pop()
+		start = time.time()
+		builds.processBuilds()
+		print 'poll after removing a branch:    %8.1f ms' % (1000 * (time.time() - start))
+
+		branchList = buildqueue.subversionClient.getBranchList()
+		start = time.time()
+		previousReconcile(pivot, platforms, branchList)
+		print 'previous reconciliation per poll: %8.1f ms' % (1000 * (time.time() - start))
+
+		buildqueue.buildDirRemover.stop()
+		buildqueue.buildDirRemover.join()
+		buildqueue.trashCan.wait()
+		print 'removed build directories: %d' % len([platform for platform in platforms if not os.path.exists(pivot + '/' + platform + '/build/' + removed)])
+	finally:
+		shutil.rmtree(pivot)
+
+##################################################################################
+if __name__ == '__main__':
+	main()
@@ -4,41 +4,302 @@ from blessings import Terminal
 import fileinput
 import re
 import time
+import os
+import sys
+import select
+import json
+import collections
 
-# This script will add color to the output of Ninja doing a GCC compilation 
+# This script will add color to the output of Ninja doing a GCC compilation
 # It will take input on stdin or use a file if supplied.
+#
+# With --buffered the input is read as binary chunks and the colored output is written
+# in large blocks instead of one write per line. Output is flushed as soon as a chunk
+# contains an error or a progress line, and otherwise at least every FLUSHINTERVAL seconds,
+# so it still looks live in a terminal.
+#
+# GCC and Clang diagnostics are collected while they stream past and summarized per file
+# at the end. --json <file> also writes them to a JSON file, e.g. for CI to pick up the
+# first errors without grepping the whole log again.
+#
+# The [N/M] progress lines get the current rate in edges per second and an estimate of the
+# remaining time. --timeseries <file> writes the time every edge finished, which shows
+# where the build stops running in parallel (e.g. when the links serialize).
 
 term = Terminal()
-errorline      = re.compile('(: error:)');
-fatalerrorline = re.compile('(: fatal error:)')
-warningline    = re.compile('(: warning:)');
-buildline      = re.compile('^\[\d+/\d+\]');
-brokeOn = ""
-
-for line in fileinput.input(bufsize=0):
-	line = line.decode('utf-8')
-
-	if errorline.search(line): 
-		lineList = errorline.split(line)
-		if len(lineList) == 3:
-			print lineList[0] + term.bold + term.red + lineList[1] + term.normal + lineList[2],
-			brokeOn = line
-	elif fatalerrorline.search(line):
-		lineList = fatalerrorline.split(line)
-		if len(lineList) == 3:
-			print lineList[0] + term.bold + term.red + lineList[1] + term.normal + lineList[2],
-			brokeOn = line
-	elif warningline.search(line):
-		lineList = warningline.split(line)
-		if len(warningline.split(line)) == 3:
-			print lineList[0] + term.bold + term.yellow + lineList[1] + term.normal + lineList[2],
-	elif buildline.search(line):
-			print term.move_up + line,
-			#time.sleep(0.1) 
+
+# One search classifies and splits a line: the whole match is the marker to color,
+# group 1 tells errors (including fatal errors) from warnings.
+diagnosticline = re.compile(': (?:fatal )?(error|warning):')
+buildline      = re.compile('\[\d+/\d+\]')
+# only run on lines diagnosticline found, e.g. ../src/foo.cpp:12:5: error: expected ';'
+diagnostic     = re.compile('^(?P<file>(?:[A-Za-z]:)?[^:]+):(?P<line>\d+):(?:(?P<column>\d+):)? (?P<severity>(?:fatal )?error|warning): (?P<message>.*?)\s*$')
+
+# the terminal capabilities are looked up on every attribute access, so do it once
+ERROR   = term.bold + term.red
+WARNING = term.bold + term.yellow
+NORMAL  = term.normal
+MOVEUP  = term.move_up
+STYLES  = (ERROR, WARNING, NORMAL, MOVEUP)
+# the same as byte strings, for coloring undecoded input
+BYTESTYLES = tuple([style.encode('utf-8') for style in STYLES])
+
+CHUNKSIZE     = 65536
+FLUSHINTERVAL = 0.1
+RATEWINDOW    = 10.0  # seconds of progress the rate is computed over
+MAXDIAGNOSTICS = 1000 # distinct diagnostics kept
+SUMMARYERRORS  = 20   # distinct errors shown at the end
+
+class Diagnostics():
+	''' Bounded store of the distinct diagnostics of a build
+
+	The same warning from a header is usually repeated for every file that includes it,
+	so diagnostics are kept once with a count. Beyond maxEntries distinct errors and
+	maxEntries distinct warnings only the totals are updated, so a flood of warnings
+	can't push out the errors. '''
+	def __init__(self, maxEntries=MAXDIAGNOSTICS):
+		self.maxEntries = maxEntries
+		self.entries = collections.OrderedDict() # (file, line, column, severity, message) -> count
+		self.distinct = {'error': 0, 'warning': 0}
+		self.totals = {}
+		self.dropped = 0
+
+	def add(self, line):
+		''' Parses line as a diagnostic, returns False if it isn't one '''
+		if isinstance(line, str):
+			line = line.decode('utf-8', 'replace')
+		match = diagnostic.match(line)
+		if not match:
+			return False
+
+		severity = match.group('severity')
+		column = match.group('column')
+		key = (match.group('file'), int(match.group('line')), int(column) if column else None, severity, match.group('message'))
+		self.totals[severity] = self.totals.get(severity, 0) + 1
+		kind = 'warning' if severity == 'warning' else 'error'
+		if key in self.entries:
+			self.entries[key] += 1
+		elif self.distinct[kind] < self.maxEntries:
+			self.entries[key] = 1
+			self.distinct[kind] += 1
+		else:
+			self.dropped += 1
+		return True
+
+	def errors(self):
+		return [key for key in self.entries if key[3] != 'warning']
+
+	def summary(self, maxErrors=SUMMARYERRORS):
+		''' Returns the distinct errors grouped by file and the warning counts per file as text '''
+		lines = []
+		errors = self.errors()
+		byFile = collections.OrderedDict()
+		for key in errors[:maxErrors]:
+			byFile.setdefault(key[0], []).append(key)
+		for filename, keys in byFile.items():
+			lines.append(term.bold + filename + term.normal)
+			for file, line, column, severity, message in keys:
+				position = str(line) + (':' + str(column) if column else '')
+				lines.append('  ' + position + ': ' + ERROR + severity + NORMAL + ': ' + message)
+		if len(errors) > maxErrors:
+			lines.append('... and %d more distinct errors' % (len(errors) - maxErrors))
+
+		warnings = collections.Counter()
+		for key, count in self.entries.items():
+			if key[3] == 'warning':
+				warnings[key[0]] += count
+		if warnings:
+			lines.append('')
+			lines.append('%d warnings (%d distinct), most in:' % (self.totals.get('warning', 0), self.distinct['warning']))
+			for filename, count in warnings.most_common(10):
+				lines.append('  %6d %s' % (count, filename))
+		if self.dropped:
+			lines.append('(%d diagnostics beyond the first %d distinct errors or warnings are only counted)' % (self.dropped, self.maxEntries))
+		return '\n'.join(lines)
+
+	def dump(self, filename):
+		records = []
+		for (file, line, column, severity, message), count in self.entries.items():
+			records.append({'file': file, 'line': line, 'column': column, 'severity': severity, 'message': message, 'count': count})
+		f = open(filename, 'w')
+		json.dump({'totals': self.totals, 'dropped': self.dropped, 'diagnostics': records}, f, indent=1)
+		f.close()
+
+class ProgressMeter():
+	''' Rolling estimate of the rate ninja finishes edges at, from its [N/M] progress lines '''
+	def __init__(self, timeseries=None):
+		self.start = time.time()
+		self.samples = collections.deque() # (time, finished edges) of the last RATEWINDOW seconds
+		self.finished = 0
+		self.total = 0
+		self.timeseries = timeseries
+
+	def update(self, line):
+		''' Records a progress line, returns the rate and the remaining seconds (None if unknown) '''
+		try:
+			finished, total = line[1:line.index(']')].split('/')
+			finished, total = int(finished), int(total)
+		except ValueError:
+			return None, None
+
+		now = time.time()
+		if self.timeseries:
+			self.timeseries.write('%.3f %d %d\n' % (now - self.start, finished, total))
+		# ninja restarts counting when it regenerates build.ninja
+		if finished < self.finished:
+			self.samples.clear()
+		self.finished = finished
+		self.total = total
+		self.samples.append((now, finished))
+		while len(self.samples) > 2 and now - self.samples[0][0] > RATEWINDOW:
+			self.samples.popleft()
+
+		elapsed = now - self.samples[0][0]
+		if elapsed <= 0:
+			return None, None
+		rate = (finished - self.samples[0][1]) / elapsed
+		if rate <= 0:
+			return rate, None
+		return rate, (total - finished) / rate
+
+	def annotate(self, line, output):
+		''' Adds the rate and the remaining time to the [N/M] of the colored progress line '''
+		rate, remaining = self.update(line)
+		if rate is None:
+			return output
+		status = ' %.1f/s' % rate
+		if remaining is not None:
+			status += ' ETA ' + formatDuration(remaining)
+		end = output.index(']')
+		return output[:end] + status + output[end:]
+
+	def summary(self):
+		elapsed = time.time() - self.start
+		return 'Finished %d of %d edges in %s (%.1f/s)' % (self.finished, self.total, formatDuration(elapsed), self.finished / max(elapsed, 0.001))
+
+def formatDuration(seconds):
+	minutes, seconds = divmod(int(seconds), 60)
+	if minutes >= 60:
+		return '%d:%02d:%02d' % (minutes / 60, minutes % 60, seconds)
+	return '%d:%02d' % (minutes, seconds)
+
+def colorize(line, styles=STYLES):
+	''' Returns the kind of line ('error', 'warning', 'progress' or None) and the line to print
+
+	line may be unicode or undecoded bytes, styles must be BYTESTYLES for the latter '''
+	error, warning, normal, moveup = styles
+	match = diagnosticline.search(line)
+	if match:
+		start, end = match.span()
+		if match.group(1) == 'error':
+			return 'error', line[:start] + error + line[start:end] + normal + line[end:]
+		return 'warning', line[:start] + warning + line[start:end] + normal + line[end:]
+	if line.startswith('[') and buildline.match(line):
+		return 'progress', moveup + line
+	return None, line
+
+def streamBuffered(stream, out, diagnostics, meter):
+	''' Colors stream to out in blocks, returns the last error line (undecoded) '''
+	fd = stream.fileno()
+	brokeOn = ''
+	partial = '' # an incomplete last line of the previous chunk
+	pending = []
+	lastFlush = time.time()
+	eof = False
+	while not eof:
+		# with output pending, wait for input no longer than until the next flush is due
+		timeout = max(0, lastFlush + FLUSHINTERVAL - time.time()) if pending else None
+		urgent = False
+		if select.select([fd], [], [], timeout)[0]:
+			chunk = os.read(fd, CHUNKSIZE)
+			if chunk:
+				lines = (partial + chunk).split('\n')
+				partial = lines.pop()
+			else:
+				eof = True
+				lines = [partial] if partial else []
+				partial = ''
+			for line in lines:
+				kind, output = colorize(line, BYTESTYLES)
+				if kind == 'error':
+					brokeOn = line + '\n'
+				if kind in ('error', 'warning'):
+					diagnostics.add(line)
+				elif kind == 'progress':
+					output = meter.annotate(line, output)
+				if kind in ('error', 'progress'):
+					urgent = True
+				pending.append(output)
+				pending.append('\n')
+			# an unterminated last line at the end of the input stays unterminated
+			if eof and lines and not chunk:
+				pending.pop()
+		else:
+			urgent = True
+
+		if pending and (urgent or eof or time.time() - lastFlush >= FLUSHINTERVAL):
+			out.write(''.join(pending))
+			out.flush()
+			pending = []
+			lastFlush = time.time()
+	return brokeOn
+
+def main():
+	brokeOn = ""
+	diagnostics = Diagnostics()
+	args = sys.argv[1:]
+
+	jsonfile = None
+	if '--json' in args:
+		jsonfile = args.pop(args.index('--json') + 1)
+		args.remove('--json')
+
+	timeseries = None
+	if '--timeseries' in args:
+		timeseries = open(args.pop(args.index('--timeseries') + 1), 'w')
+		args.remove('--timeseries')
+	meter = ProgressMeter(timeseries)
+
+	if '--buffered' in args:
+		args.remove('--buffered')
+		if not args:
+			brokeOn = streamBuffered(sys.stdin, sys.stdout, diagnostics, meter)
+		for filename in args:
+			f = open(filename, 'rb')
+			brokeOn = streamBuffered(f, sys.stdout, diagnostics, meter) or brokeOn
+			f.close()
+		brokeOn = brokeOn.decode('utf-8', 'replace')
+	else:
+		for line in fileinput.input(args, bufsize=0):
+			line = line.decode('utf-8')
+
+			kind, output = colorize(line)
+			if kind == 'error':
+				brokeOn = line
+			if kind in ('error', 'warning'):
+				diagnostics.add(line)
+			elif kind == 'progress':
+				output = meter.annotate(line, output)
+			print output,
+
+	if jsonfile:
+		diagnostics.dump(jsonfile)
+	if timeseries:
+		timeseries.close()
+
+	if meter.total:
+		print "\n" + meter.summary()
+	if len(brokeOn) == 0:
+		print "\nYour build ran OK.\n"
+	elif diagnostic.match(brokeOn):
+		# it is in the summary below
+		print "\nYour build broke on the following:\n"
 	else:
-		print line,
+		# e.g. a linker or ninja error, which has no file and line
+		print "\nYour build broke on the following:\n" + term.bold + brokeOn + term.normal
+	if diagnostics.entries:
+		print diagnostics.summary()
 
-if len(brokeOn) == 0:
-	print "\nYour build ran OK.\n"
-else:
-	print "\nYour build broke on the following:\n" + term.bold + brokeOn + term.normal
+##################################################################################
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+# Companion of ninja-color: reports on the .ninja_log files of finished builds which
+# targets took longest and which chain of edges the build waited on (the critical path).
+# It shows which translation units are worth splitting or precompiling and, over the
+# build directories of several branches, which targets got slower.
+#
+# Without directories it searches the build directories of buildqueue below the
+# pivotdirectory of /etc/buildqueue or ~/.buildqueue. The logs are analyzed in parallel
+# and every report is cached next to its log until the log changes.
+#
+# usage: ninja-log-report.py [--top N] [--json <file>] [build directories or .ninja_log files]
+
+import os
+import sys
+import mmap
+import json
+import bisect
+import ConfigParser
+import multiprocessing
+
+NINJALOG  = '.ninja_log'
+CACHE     = '.ninja_log.report'
+MAXDEPTH  = 4  # how deep below the pivotdirectory to look for build directories
+KEEPTOP   = 100 # slowest edges kept in a report
+REPORTVERSION = 1
+
+def parseLog(path):
+	''' Returns the edges of the last build in the ninja log as a list of (start, end, outputs)
+	with the times in milliseconds
+
+	Ninja appends an entry for every edge that finishes, in the order they finish and with
+	times relative to the start of the build, so the end times only go back where a new
+	build started. An edge with several outputs has an entry for each of them. '''
+	f = open(path, 'rb')
+	try:
+		if os.fstat(f.fileno()).st_size == 0:
+			return []
+		log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	finally:
+		f.close()
+
+	edges = {}
+	lastEnd = 0
+	try:
+		for line in iter(log.readline, ''):
+			if line.startswith('#'):
+				continue
+			fields = line.rstrip('\r\n').split('\t')
+			if len(fields) < 4:
+				continue
+			try:
+				start, end = int(fields[0]), int(fields[1])
+			except ValueError:
+				continue
+			if end < lastEnd:
+				edges = {}
+			lastEnd = end
+			# version 4 logs have no command hash
+			key = (start, end, fields[4] if len(fields) > 4 else fields[3])
+			edges.setdefault(key, []).append(fields[3])
+	finally:
+		log.close()
+
+	return [(start, end, outputs) for (start, end, command), outputs in edges.items()]
+
+def criticalPath(edges):
+	''' Returns the chain of edges the build waited on, as far as the timing shows it
+
+	The log has no dependencies, so starting from the edge that finished last, every step
+	goes back to the edge that finished last before the current one started. That is the
+	edge that most likely held it up. '''
+	if not edges:
+		return []
+	edges = sorted(edges, key=lambda edge: edge[1])
+	ends = [edge[1] for edge in edges]
+	index = len(edges) - 1
+	path = [edges[index]]
+	while True:
+		# only look at the edges before the current one, zero length edges end where they start
+		index = bisect.bisect_right(ends, path[-1][0], 0, index) - 1
+		if index < 0:
+			break
+		path.append(edges[index])
+	path.reverse()
+	return path
+
+def analyze(path):
+	''' Returns the report of a ninja log, from the cache when the log didn't change '''
+	stat = os.stat(path)
+	cachefile = os.path.join(os.path.dirname(path), CACHE)
+	try:
+		f = open(cachefile, 'r')
+		report = json.load(f)
+		f.close()
+		if report.get('version') == REPORTVERSION and report['mtime'] == stat.st_mtime and report['size'] == stat.st_size:
+			return report
+	except (IOError, ValueError, KeyError):
+		pass
+
+	edges = parseLog(path)
+	durations = {}
+	for start, end, outputs in edges:
+		durations[outputs[0]] = end - start
+	total = sum(durations.values())
+	wall = max([end for start, end, outputs in edges] or [0]) - min([start for start, end, outputs in edges] or [0])
+	chain = criticalPath(edges)
+
+	report = {
+		'version': REPORTVERSION,
+		'log': path,
+		'mtime': stat.st_mtime,
+		'size': stat.st_size,
+		'edges': len(edges),
+		'wall': wall,
+		'total': total,
+		'critical': [[outputs[0], end - start] for start, end, outputs in chain],
+		'slowest': sorted(durations.items(), key=lambda item: item[1], reverse=True)[:KEEPTOP],
+		'durations': durations,
+	}
+
+	try:
+		f = open(cachefile + '.tmp', 'w')
+		json.dump(report, f)
+		f.close()
+		os.rename(cachefile + '.tmp', cachefile)
+	except (IOError, OSError), e:
+		print >> sys.stderr, 'could not cache the report of ' + path + ': ' + str(e)
+	return report
+
+def findLogs(top, depth=MAXDEPTH):
+	logs = []
+	for root, dirs, files in os.walk(top):
+		if NINJALOG in files:
+			logs.append(os.path.join(root, NINJALOG))
+			# a build directory does not contain other build directories
+			dirs[:] = []
+		elif root[len(top):].count(os.sep) >= depth:
+			dirs[:] = []
+		else:
+			dirs[:] = [d for d in dirs if not d.startswith('.')]
+	return logs
+
+def pivotDirectory():
+	config = ConfigParser.SafeConfigParser()
+	config.read(['/etc/buildqueue', os.path.expanduser('~/.buildqueue')])
+	try:
+		pivot = config.get('general', 'pivotdirectory')
+	except ConfigParser.Error:
+		return None
+	return os.path.normpath(os.path.expandvars(pivot)) if pivot else None
+
+def seconds(milliseconds):
+	return '%7.1fs' % (milliseconds / 1000.0)
+
+def printReport(report, top):
+	print report['log']
+	if not report['edges']:
+		print '  no edges'
+		return
+	print '  %d edges, wall time %s, %s in edges (%.1f in parallel)' % (report['edges'], seconds(report['wall']).strip(), seconds(report['total']).strip(), report['total'] / float(max(report['wall'], 1)))
+	print '  critical path of %d edges, %s:' % (len(report['critical']), seconds(sum([duration for target, duration in report['critical']])).strip())
+	for target, duration in report['critical']:
+		print '    ' + seconds(duration) + ' ' + target
+	print '  slowest edges:'
+	for target, duration in report['slowest'][:top]:
+		print '    ' + seconds(duration) + ' ' + target
+
+def printDifferences(reports, top):
+	''' Prints the targets whose duration differs most between the builds '''
+	builds = {}
+	for report in reports:
+		for target, duration in report['durations'].items():
+			builds.setdefault(target, []).append((duration, report['log']))
+	differences = []
+	for target, durations in builds.items():
+		if len(durations) > 1:
+			durations.sort()
+			differences.append((durations[-1][0] - durations[0][0], target, durations[0], durations[-1]))
+	differences.sort(reverse=True)
+
+	if differences:
+		print 'largest differences between the builds:'
+	for difference, target, fastest, slowest in differences[:top]:
+		print '  ' + seconds(difference) + ' ' + target
+		print '      ' + seconds(fastest[0]) + ' ' + fastest[1]
+		print '      ' + seconds(slowest[0]) + ' ' + slowest[1]
+
+def main():
+	args = sys.argv[1:]
+	top = 20
+	if '--top' in args:
+		top = int(args.pop(args.index('--top') + 1))
+		args.remove('--top')
+	jsonfile = None
+	if '--json' in args:
+		jsonfile = args.pop(args.index('--json') + 1)
+		args.remove('--json')
+
+	if not args:
+		pivot = pivotDirectory()
+		if not pivot:
+			print 'usage: ' + sys.argv[0] + ' [--top N] [--json <file>] [build directories or ' + NINJALOG + ' files]'
+			print 'without arguments the pivotdirectory of the buildqueue configuration is searched'
+			sys.exit(1)
+		args = [pivot]
+
+	logs = []
+	for arg in args:
+		if os.path.isfile(arg):
+			logs.append(arg)
+		elif os.path.isfile(os.path.join(arg, NINJALOG)):
+			logs.append(os.path.join(arg, NINJALOG))
+		else:
+			logs.extend(findLogs(arg))
+
+	if len(logs) > 1:
+		pool = multiprocessing.Pool()
+		reports = pool.map(analyze, logs)
+		pool.close()
+		pool.join()
+	else:
+		reports = map(analyze, logs)
+
+	for report in reports:
+		printReport(report, top)
+		print
+	if len(reports) > 1:
+		printDifferences(reports, top)
+
+	if jsonfile:
+		f = open(jsonfile, 'w')
+		json.dump([dict([(key, value) for key, value in report.items() if key != 'durations']) for report in reports], f, indent=1)
+		f.close()
+
+##################################################################################
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Throughput benchmark for the ninja-color line classifier. It replays a recorded ninja log
+# (e.g. ninja 2>&1 | tee build.log) through the classifier of ninja-color and through the
+# previous one, which ran a separate regex search per kind of line and split again, and
+# reports lines and megabytes per second. Nothing is written to the terminal.
+#
+# usage: throughput-benchmark.py <ninja log> [repeats]
+
+import os
+import re
+import sys
+import time
+import imp
+
+ninjacolor = imp.load_source('ninjacolor', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ninja-color.py'))
+
+errorline      = re.compile('(: error:)')
+fatalerrorline = re.compile('(: fatal error:)')
+warningline    = re.compile('(: warning:)')
+buildline      = re.compile('^\[\d+/\d+\]')
+
+def previous(line):
+	# the classifier as it was, for comparison
+	if errorline.search(line):
+		lineList = errorline.split(line)
+		if len(lineList) == 3:
+			return 'error', lineList[0] + ninjacolor.ERROR + lineList[1] + ninjacolor.NORMAL + lineList[2]
+	elif fatalerrorline.search(line):
+		lineList = fatalerrorline.split(line)
+		if len(lineList) == 3:
+			return 'error', lineList[0] + ninjacolor.ERROR + lineList[1] + ninjacolor.NORMAL + lineList[2]
+	elif warningline.search(line):
+		lineList = warningline.split(line)
+		if len(warningline.split(line)) == 3:
+			return 'warning', lineList[0] + ninjacolor.WARNING + lineList[1] + ninjacolor.NORMAL + lineList[2]
+	elif buildline.search(line):
+		return 'progress', ninjacolor.MOVEUP + line
+	return None, line
+
+def measure(classify, lines, repeats):
+	best = None
+	for i in range(repeats):
+		start = time.time()
+		for line in lines:
+			classify(line)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def main():
+	if len(sys.argv) < 2:
+		print 'usage: ' + sys.argv[0] + ' <ninja log> [repeats]'
+		sys.exit(1)
+	repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+	f = open(sys.argv[1], 'rb')
+	lines = [line.decode('utf-8', 'replace') for line in f]
+	f.close()
+	megabytes = os.path.getsize(sys.argv[1]) / 1048576.0
+
+	counts = {}
+	for line in lines:
+		kind = ninjacolor.colorize(line)[0]
+		counts[kind] = counts.get(kind, 0) + 1
+	print '%d lines (%.1f MB): %d errors, %d warnings, %d progress' % (len(lines), megabytes,
+		counts.get('error', 0), counts.get('warning', 0), counts.get('progress', 0))
+
+	for name, classify in (('previous', previous), ('single pass', ninjacolor.colorize)):
+		elapsed = measure(classify, lines, repeats)
+		print '%-12s %8.0f lines/s %8.1f MB/s' % (name, len(lines) / elapsed, megabytes / elapsed)
+
+##################################################################################
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,135 @@
+# Two phase removal of directories, shared by buildqueue and buildbot-cleanup.
+# A doomed directory is first renamed into a .buildtrash directory next to it, which is
+# instant, so its name can be reused right away. A background reaper then
+# removes the contents of the trash at a limited rate, so the deletion does not starve
+# running builds of disk bandwidth.
+
+import os
+import time
+import errno
+import threading
+import logging
+
+TRASH = '.buildtrash'
+
+def findTrash(path):
+	''' Returns the trash directory for path: .buildtrash next to it, so renaming into it
+	stays on the same filesystem and every tree of build directories has a trash of its own '''
+	return os.path.join(os.path.dirname(os.path.abspath(path)), TRASH)
+
+class TrashCan():
+	''' Renames directories into the trash and reaps the trash in a background thread
+
+	rate limits the reaper to that many removed files per second, 0 means no limit. '''
+	def __init__(self, rate=0, log=None):
+		self.rate = rate
+		self.log = log or logging.getLogger()
+		self.lock = threading.Lock()
+		self.changed = threading.Condition(self.lock)
+		self.trashes = set() # trash directories that may contain something
+		self.busy = False
+		self.stopped = False
+		self.files = 0
+		self.bytes = 0
+		self.reaper = None
+
+	def trash(self, path, trash=None):
+		''' Move path into the trash, returns False if that is not possible (the caller
+		should then remove it in place). trash defaults to the one next to path, a trash
+		higher up on the same filesystem keeps the directories in between clean. '''
+		try:
+			if trash is None:
+				trash = findTrash(path)
+			try:
+				os.mkdir(trash)
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise
+			# keep the name recognizable and unique
+			target = os.path.join(trash, '%s-%d-%d' % (os.path.basename(path), os.getpid(), time.time() * 1000000))
+			os.rename(path, target)
+		except OSError, e:
+			# e.g. EXDEV when path is a mount point of its own
+			if e.errno != errno.EXDEV:
+				self.log.warning('failed to move ' + path + ' to the trash: ' + str(e))
+			return False
+
+		self.adopt(trash)
+		return True
+
+	def adopt(self, trash):
+		''' Have the reaper empty trash, e.g. one left behind by an earlier run '''
+		if not os.path.isdir(trash):
+			return
+		self.lock.acquire()
+		self.trashes.add(trash)
+		self.changed.notifyAll()
+		self.lock.release()
+
+	def start(self):
+		self.reaper = threading.Thread(target=self.reap, name='reaper')
+		self.reaper.setDaemon(True)
+		self.reaper.start()
+
+	def stop(self):
+		self.lock.acquire()
+		self.stopped = True
+		self.changed.notifyAll()
+		self.lock.release()
+
+	def wait(self):
+		''' Block until the reaper has emptied all trash '''
+		self.lock.acquire()
+		while (self.trashes or self.busy) and not self.stopped:
+			self.changed.wait()
+		self.lock.release()
+
+	def reap(self):
+		while True:
+			self.lock.acquire()
+			while not self.trashes and not self.stopped:
+				self.busy = False
+				self.changed.notifyAll()
+				self.changed.wait()
+			if self.stopped:
+				self.lock.release()
+				return
+			trash = self.trashes.pop()
+			self.busy = True
+			self.lock.release()
+
+			self.empty(trash)
+
+	def empty(self, trash):
+		window = time.time()
+		removed = 0
+		for root, dirs, files in os.walk(trash, topdown=False):
+			for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+				if self.stopped:
+					return
+				try:
+					size = os.lstat(os.path.join(root, name)).st_size
+					os.remove(os.path.join(root, name))
+				except OSError, e:
+					self.log.warning('failed to remove ' + os.path.join(root, name) + ' from the trash: ' + str(e))
+					continue
+
+				self.lock.acquire()
+				self.files += 1
+				self.bytes += size
+				self.lock.release()
+
+				# simple rate limit: at most self.rate files per one second window
+				removed += 1
+				if self.rate and removed >= self.rate:
+					elapsed = time.time() - window
+					if elapsed < 1.0:
+						time.sleep(1.0 - elapsed)
+					window = time.time()
+					removed = 0
+
+			if root != trash:
+				try:
+					os.rmdir(root)
+				except OSError, e:
+					self.log.warning('failed to remove ' + root + ' from the trash: ' + str(e))